@@ -131,6 +131,14 @@ const updateTranscript = async (req, res) => {
 
 }
 
+// version of the event stream sent by the Flask /process endpoint
+const STREAM_PROTOCOL_VERSION = 1;
+
+// user-facing messages for error codes of the Flask service
+const errorMessages = {
+  TIMEOUT: 'The transcription service timed out. Please try again with a shorter audio file or try later.',
+};
+
 const uploadAudioFile = (req, res) => {
   try {
     if (!req.file) {
@@ -157,79 +165,107 @@ const uploadAudioFile = (req, res) => {
       timeout: 300000, // 5 minute timeout for the entire request
     })
       .then(response => {
-        let transcriptionData = '';
+        // The Flask service streams NDJSON events (see PROTOCOL_VERSION in app.py),
+        // they are relayed to the client as transcript/summary/error messages
+        const transcriptParts = [];
+        const seenChunks = new Set();
         let summary = '';
-        let summaryGenerated = false;
+        let pending = '';
+        let finished = false;
 
-        response.data.on('data', (chunk) => {
-          let chunkStr = chunk.toString();
-          console.log('Received chunk:', chunkStr);
-          
-          try {
-            // Try to parse the chunk as JSON to check for errors
-            const jsonChunk = JSON.parse(chunkStr);
-            if (jsonChunk.error) {
-              console.log(jsonChunk)
-              // Enhanced error type checking
-              if (jsonChunk.error.includes('timed out') || 
-                  jsonChunk.error.includes('timeout') ||
-                  jsonChunk.error.includes('TimeoutError')) {
-                res.write(JSON.stringify({ 
-                  type: 'error', 
-                  code: 'TIMEOUT',
-                  data: 'The transcription service timed out. Please try again with a shorter audio file or try later.'
-                }) + '\n');
-              } else if (jsonChunk.error.includes('too busy')) {
-                res.write(JSON.stringify({ 
-                  type: 'error', 
-                  code: 'BUSY',
-                  data: 'The service is currently too busy. Please try again in a few minutes.'
-                }) + '\n');
-              } else {
-                res.write(JSON.stringify({ 
-                  type: 'error', 
-                  code: 'TRANSCRIPTION_ERROR',
-                  data: 'An error occurred during transcription: ' + jsonChunk.error
-                }) + '\n');
+        const finish = () => {
+          finished = true;
+          cleanupUploads();
+          res.end();
+        };
+
+        const handleEvent = (event) => {
+          if (event.v !== STREAM_PROTOCOL_VERSION) {
+            console.warn(`Unexpected stream protocol version ${event.v}`);
+          }
+          switch (event.type) {
+            case 'start':
+              console.log(`Transcribing ${event.num_chunks} chunks (${event.duration_ms} ms) with ${event.backend}`);
+              break;
+            case 'chunk':
+              // chunks may be sent again when a transcription is resumed
+              if (seenChunks.has(event.index)) {
+                return;
               }
-              // Clean up and end the response
-              cleanupUploads();
-              res.end();
-              return;
-            }
+              seenChunks.add(event.index);
+              transcriptParts.push(event.text + '\n');
+              res.write(JSON.stringify({ type: 'transcript', data: event.text + '\n' }) + '\n');
+              break;
+            case 'progress':
+              console.log(`Transcription progress: ${event.completed}/${event.total}`);
+              break;
+            case 'summary':
+              summary = event.text;
+              break;
+            case 'metrics':
+              console.log('Transcription metrics:', event);
+              break;
+            case 'error':
+              console.log('Transcription error:', event);
+              res.write(JSON.stringify({
+                type: 'error',
+                code: event.code,
+                data: errorMessages[event.code] || 'An error occurred during transcription: ' + event.message
+              }) + '\n');
+              if (event.fatal) {
+                finish();
+              }
+              break;
+            default:
+              console.warn('Unknown stream event:', event.type);
+          }
+        };
+
+        const handleLine = (line) => {
+          if (!line.trim()) {
+            return;
+          }
+          try {
+            handleEvent(JSON.parse(line));
           } catch (e) {
-            // Not JSON, process as normal chunk
-            //add extra error checking in case it's not recognized as an error
-            if (chunkStr.includes('timed out') || 
-              chunkStr.includes('timeout') ||
-              chunkStr.includes('TimeoutError')) {
-            res.write(JSON.stringify({ 
-              type: 'error', 
-              code: 'TIMEOUT',
-              data: 'The transcription service timed out. Please try again with a shorter audio file or try later.'
-            }) + '\n')
-            } else if (chunkStr.startsWith('SUMMARY:') || summaryGenerated) {
-              console.log("summary detected");
-              summaryGenerated = true;
-              summary += chunkStr.replace('SUMMARY:', '').trim();
-            } else if (chunkStr.trim() === "transcription complete") {
-              transcriptionData += '.';
-              res.write(JSON.stringify({ type: 'transcript', data: '.' }) + '\n');
-            } else {
-              transcriptionData += chunkStr + '\n';
-              res.write(JSON.stringify({ type: 'transcript', data: chunkStr + '\n' }) + '\n');
+            console.error('Failed to parse stream event:', line, e.message);
+          }
+        };
+
+        // decode as a stream so that characters split between chunks are kept whole
+        response.data.setEncoding('utf8');
+        response.data.on('data', (data) => {
+          if (finished) {
+            return;
+          }
+          // events can be split across or packed into network chunks, only complete lines are parsed
+          pending += data;
+          const lines = pending.split('\n');
+          pending = lines.pop();
+          for (const line of lines) {
+            if (finished) {
+              return;
             }
+            handleLine(line);
           }
         });
     
         response.data.on('end', () => {
           console.log('Python process closed');
+          if (finished) {
+            return;
+          }
+          handleLine(pending);
+          if (finished) {
+            return;
+          }
           if (summary) {
             res.write(JSON.stringify({ type: 'summary', data: summary }) + '\n');
           }
           res.end();
     
           try {
+            const transcriptionData = transcriptParts.join('');
             const userId = req.user?.sub || 'default_user';
             createTranscriptService({
               title: 'Untitled Transcript',
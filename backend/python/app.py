@@ -1,8 +1,5 @@
 from flask import Flask, request, jsonify, Response
-from pydub import AudioSegment
-from pydub.utils import which
 import json
-import ffmpeg
 import sys
 import traceback
 import os
@@ -12,6 +9,8 @@ from flask_cors import CORS
 import psutil
 import time
 import requests
+from pcm_spool import PcmSpool, is_silent
+from transcription import TranscriptionError, create_backend
 
 def log_memory_usage(stage):
     process = psutil.Process()
@@ -27,136 +26,121 @@ CORS(app, resources={r"/*": {"origins": [NODE_URL, LOCALHOST_URL]}})
 
 CHUNK_SIZE = 45 * 1 * 1000  # 1 min in milliseconds
 MAX_WORKERS = 3  # Limit concurrent processing
+# chunks quieter than this many dBFS are not transcribed when set, e.g. -60 to skip
+# digital silence and room tone; quiet speech can fall below -50 so keep it low
+SILENCE_THRESHOLD_DBFS = float(os.getenv('SILENCE_THRESHOLD_DBFS')) if os.getenv('SILENCE_THRESHOLD_DBFS') else None
+
+# /process streams one JSON event per line (NDJSON), each carrying the protocol version
+# and its type:
+#   start     duration_ms, chunk_ms, num_chunks, backend
+#   chunk     index, offset_ms, duration_ms, text  (no event for chunks skipped below SILENCE_THRESHOLD_DBFS)
+#   progress  completed, total, audio_ms, elapsed_ms  (after each chunk)
+#   summary   text
+#   metrics   timings of the whole request, always the last event of a successful stream
+#   error     code, message, fatal, and index for chunks that failed; fatal errors end the stream
+PROTOCOL_VERSION = 1
+
+
+def event(type, **fields):
+    return {"v": PROTOCOL_VERSION, "type": type, **fields}
 
 class ChunkedAudioProcessor:
     def __init__(self):
         self.FRAME_RATE = 16000
         self.CHANNELS = 1
-        AudioSegment.converter = which("ffmpeg")
         self.current_dir = os.path.dirname(os.path.abspath(__file__))
+        # selected with TRANSCRIPTION_BACKEND / TRANSCRIPTION_FALLBACK, local models are loaded once per process
+        self.backend = create_backend()
+        print(f"Transcription backend: {self.backend.name}", file=sys.stderr)
         
     def process_audio_chunk(self, chunk):
-        retries=3
-        backoff_factor=2
-        """Process a single audio chunk."""
-        temp_chunk_path = f"temp_chunk_{time.time()}.wav"
-        chunk.export(temp_chunk_path, format="wav")
-        
-        TRANSCRIPTION_API_URL = "https://api-inference.huggingface.co/models/openai/whisper-large-v3"
-        headers = {"Authorization": f"Bearer {os.getenv('HUGGING_TOKEN')}"}
-        
-        with open(temp_chunk_path, "rb") as f:
-            data = f.read()
-        
-        for attempt in range(retries):
-            try:
-                response = requests.post(TRANSCRIPTION_API_URL, headers=headers, data=data, timeout=30)
-                if response.status_code == 200:
-                    result = response.json()
-                    transcript_chunk = result["text"].strip()
-                    if isinstance(result, dict) and "text" in result:
-                        return transcript_chunk
-                else:
-                    print(f"API returned status {response.status_code}. Retrying...", file=sys.stderr)
-            except requests.exceptions.RequestException as e:
-                print(f"Request failed: {e}. Retrying...", file=sys.stderr)
-            time.sleep(backoff_factor ** attempt)
-        
-        error_msg = {
-            "type": "error",
-            "code": "TIMEOUT",
-            "data": f"The transcription service timed out or encountered an error: {str(e)}"
-        }
-        return json.dumps(error_msg) + '\n'
-        raise Exception("Max retries reached for chunk transcription")
-        '''response = requests.post(TRANSCRIPTION_API_URL, headers=headers, data=data)
-        result = response.json()
-        
-        if isinstance(result, dict) and "text" in result:
-            return result["text"].strip()
-        return ""'''
+        """Process a single audio chunk, raises TranscriptionError on failure."""
+        return self.backend.transcribe(chunk, self.FRAME_RATE, self.CHANNELS)
 
     def transcribe_audio_in_chunks(self, filename):
-        wav_filename = None
+        """Transcribe a file chunk by chunk, yielding protocol events (see event())."""
+        spool = None
+        started = time.perf_counter()
         try:
-            # Convert input file to standard format
-            audio = AudioSegment.from_file(filename)
-            audio = audio.set_channels(self.CHANNELS)
-            audio = audio.set_frame_rate(self.FRAME_RATE)
-
-            SUPPORTED_FORMATS = {'mp3', 'wav', 'flac', 'aac', 'ogg'}
+            SUPPORTED_FORMATS = {'mp3', 'wav', 'flac', 'aac', 'ogg', 'webm'}
             file_extension = filename.split('.')[-1].lower()
-            if file_extension == 'webm':
-                # Convert WebM to MP3
-                wav_filename = filename.rsplit('.', 1)[0] + '.wav'
-                ffmpeg.input(filename).output(wav_filename, acodec='pcm_s16le').run()
-                audio = AudioSegment.from_file(wav_filename) # Load the wav file
-                audio = audio.set_channels(self.CHANNELS)
-                audio = audio.set_frame_rate(self.FRAME_RATE)
-            elif file_extension not in SUPPORTED_FORMATS:
-                print(json.dumps({
-                    "error": f"Unsupported file format: {file_extension}",
-                    "supported_formats": list(SUPPORTED_FORMATS)
-                }), file=sys.stderr) 
+            if file_extension not in SUPPORTED_FORMATS:
+                yield event("error", code="UNSUPPORTED_FORMAT", fatal=True,
+                            message=f"Unsupported file format: {file_extension}, expected one of {', '.join(sorted(SUPPORTED_FORMATS))}")
                 return
 
-            # Process audio in chunks
-            length_ms = len(audio)
+            # Decode once to a memory-mapped 16 kHz mono PCM spool, chunks are views into it
+            spool = PcmSpool(filename, self.FRAME_RATE, self.CHANNELS)
+            decode_ms = (time.perf_counter() - started) * 1000
+            log_memory_usage("after decoding")
+
+            length_ms = spool.duration_ms
+            offsets = range(0, length_ms, CHUNK_SIZE)
+            yield event("start", duration_ms=length_ms, chunk_ms=CHUNK_SIZE, num_chunks=len(offsets), backend=self.backend.name)
+
             full_transcript = []
-            
-            for i in range(0, length_ms, CHUNK_SIZE):
-                print(f"transcribing chunk {i}", file=sys.stderr)
-                chunk = audio[i:min(i + CHUNK_SIZE, length_ms)]
-                
-                # Process chunk and get transcription
-                chunk_transcript = self.process_audio_chunk(chunk)
-                if chunk_transcript:
-                    #print(f"Type of chunk_transcript: {type(chunk_transcript)}")  # Debugging
-                    if isinstance(chunk_transcript, str):
-                        full_transcript.append(chunk_transcript)
-                    else:
-                        print(f"Unexpected type: {type(chunk_transcript)}", file=sys.stderr)
-                    # Yield intermediate results
-                    yield f"{chunk_transcript}\n"
-                    print(f"chunk {i} transcription complete", file=sys.stderr)
-                
-                # Free up memory
+            transcribe_ms = 0
+            skipped = failed = 0
+            for index, offset_ms in enumerate(offsets):
+                duration_ms = min(CHUNK_SIZE, length_ms - offset_ms)
+                chunk = spool.slice_ms(offset_ms, offset_ms + duration_ms)
+                if SILENCE_THRESHOLD_DBFS is not None and is_silent(chunk, SILENCE_THRESHOLD_DBFS):
+                    print(f"skipping silent chunk {index}", file=sys.stderr)
+                    skipped += 1
+                else:
+                    print(f"transcribing chunk {index}", file=sys.stderr)
+                    chunk_started = time.perf_counter()
+                    try:
+                        text = self.process_audio_chunk(chunk)
+                        error = None
+                    except TranscriptionError as e:
+                        text = None
+                        error = e
+                    transcribe_ms += (time.perf_counter() - chunk_started) * 1000
+                    if error is not None:
+                        # the chunk is lost but the rest of the file can still be transcribed
+                        failed += 1
+                        yield event("error", code=error.code, message=str(error), fatal=False, index=index)
+                    elif text:
+                        full_transcript.append(text)
+                        yield event("chunk", index=index, offset_ms=offset_ms, duration_ms=duration_ms, text=text)
                 del chunk
-                
-                # Log memory usage
-                log_memory_usage(f"chunk_{i}")
-            
-            # Combine all transcripts
-            complete_transcript = " ".join(full_transcript)
-            
+                yield event("progress", completed=index + 1, total=len(offsets),
+                            audio_ms=offset_ms + duration_ms, elapsed_ms=round((time.perf_counter() - started) * 1000))
+                log_memory_usage(f"chunk_{index}")
+
             # Generate summary only after all chunks are processed
+            summarize_ms = 0
+            complete_transcript = " ".join(full_transcript)
             if complete_transcript:
+                summarize_started = time.perf_counter()
                 summary = self.summarize_text(complete_transcript)
-                yield f"SUMMARY:{summary}\n"
-            
+                summarize_ms = (time.perf_counter() - summarize_started) * 1000
+                yield event("summary", text=summary)
+
+            total_ms = (time.perf_counter() - started) * 1000
+            yield event("metrics",
+                        audio_ms=length_ms,
+                        decode_ms=round(decode_ms),
+                        transcribe_ms=round(transcribe_ms),
+                        summarize_ms=round(summarize_ms),
+                        total_ms=round(total_ms),
+                        realtime_factor=round(transcribe_ms / length_ms, 4) if length_ms else None,
+                        chunks=len(offsets),
+                        skipped_chunks=skipped,
+                        failed_chunks=failed,
+                        rss_mb=round(psutil.Process().memory_info().rss / (1024 * 1024), 1))
+
         except Exception as e:
-            error_msg = {
+            print(json.dumps({
                 "error": f"Transcription failed: {str(e)}",
                 "traceback": traceback.format_exc()
-            }
-            print(json.dumps(error_msg), file=sys.stderr)
-            yield json.dumps(error_msg)
-        
-        current_directory = os.getcwd()
-
-        # Loop through all files in the directory
-        for file_name in os.listdir(current_directory):
-            # Check if the file has a .wav extension
-            if file_name.endswith('.wav'):
-                file_path = os.path.join(current_directory, file_name)
-                try:
-                    # Delete the file
-                    os.remove(file_path)
-                    print(f"Deleted: {file_name}")
-                except Exception as e:
-                    print(f"Error deleting {file_name}: {e}")
-
-        print("All .wav files have been deleted.")
+            }), file=sys.stderr)
+            yield event("error", code="TRANSCRIPTION_ERROR", message=f"Transcription failed: {str(e)}", fatal=True)
+
+        finally:
+            if spool is not None:
+                spool.close()
 
     def summarize_text(self, transcript):
         # Break long transcripts into smaller chunks for summarization
@@ -207,21 +191,21 @@ def process_audio():
 
     def generate():
         try:
-            for chunk in processor.transcribe_audio_in_chunks(audio_file_path):
-                yield chunk
+            for item in processor.transcribe_audio_in_chunks(audio_file_path):
+                yield json.dumps(item) + '\n'
         except Exception as e:
-            error_msg = {
+            print(json.dumps({
                 "error": f"Processing failed: {str(e)}",
                 "traceback": traceback.format_exc()
-            }
-            yield json.dumps(error_msg)
-        
+            }), file=sys.stderr)
+            yield json.dumps(event("error", code="PROCESSING_ERROR", message=f"Processing failed: {str(e)}", fatal=True)) + '\n'
+        finally:
             try:
                 os.remove(audio_file_path)
             except Exception as e:
                 print(f"Cleanup error: {e}", file=sys.stderr)
 
-    return Response(generate(), content_type='text/plain;charset=utf-8', status=200)
+    return Response(generate(), content_type='application/x-ndjson;charset=utf-8', status=200)
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,93 @@
+import io
+import os
+import tempfile
+import wave
+
+import ffmpeg
+import numpy as np
+
+SAMPLE_WIDTH = 2  # signed 16-bit little endian
+
+
+def wav_bytes(samples, frame_rate, channels=1):
+    """Wrap a block of PCM samples in a WAV container, ready to be sent over HTTP."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(frame_rate)
+        wav.writeframes(memoryview(np.ascontiguousarray(samples)).cast('B'))
+    return buffer.getvalue()
+
+
+def rms_dbfs(samples):
+    """Loudness of a block of PCM samples relative to full scale."""
+    if len(samples) == 0:
+        return float('-inf')
+    rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+    if rms == 0:
+        return float('-inf')
+    return 20 * np.log10(rms / 32768.0)
+
+
+def is_silent(samples, threshold_dbfs):
+    """Whether a block of PCM samples is quieter than threshold_dbfs, e.g. -60."""
+    return rms_dbfs(samples) < threshold_dbfs
+
+
+class PcmSpool:
+    """Decoded audio spooled to disk once and memory-mapped.
+
+    The input file is decoded by ffmpeg straight into a raw s16le file, which is
+    then mapped read-only. Slices returned by `slice_ms` are views into the
+    mapping, so resident memory stays flat however long the recording is and
+    paging is left to the OS page cache.
+    """
+
+    def __init__(self, filename, frame_rate=16000, channels=1, spool_dir=None):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        fd, self.path = tempfile.mkstemp(prefix='spool_', suffix='.pcm', dir=spool_dir)
+        os.close(fd)
+        try:
+            (ffmpeg
+                .input(filename)
+                .output(self.path, format='s16le', acodec='pcm_s16le', ac=channels, ar=frame_rate)
+                .overwrite_output()
+                .run(quiet=True))
+        except Exception:
+            os.remove(self.path)
+            raise
+        if os.path.getsize(self.path) > 0:
+            self.samples = np.memmap(self.path, dtype='<i2', mode='r')
+        else:
+            # numpy refuses to map empty files
+            self.samples = np.zeros(0, dtype='<i2')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.samples) // self.channels
+
+    @property
+    def duration_ms(self):
+        return len(self) * 1000 // self.frame_rate
+
+    def slice_ms(self, start_ms, end_ms):
+        """Zero-copy view of the samples between two offsets in milliseconds."""
+        start = start_ms * self.frame_rate // 1000 * self.channels
+        end = end_ms * self.frame_rate // 1000 * self.channels
+        return self.samples[start:end]
+
+    def close(self):
+        # the mapping is released once the last view into it is dropped, unlinking
+        # the spool file early is fine on POSIX
+        self.samples = np.zeros(0, dtype='<i2')
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,218 @@
+"""Speed and accuracy benchmark of a recasepunc model on the vosk-adapted fixtures.
+
+    python3 benchmark.py checkpoint --output results.json
+    python3 benchmark.py checkpoint --precision int8 --baseline results.json
+
+Times tokenization, prediction and detokenization on vosk-adapted.txt and on longer
+synthetic inputs made from its words, measures model load time, single window latency
+and peak memory, and scores the output against vosk-adapted.txt.punc. With --baseline,
+results are compared to a previous run and the exit status is 1 if the punctuation or
+case F-score dropped by more than --tolerance.
+"""
+import argparse
+import difflib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import logging
+
+from recasepunc import CasePuncPredictor, Detokenizer, default_config, label_fscores, labeled_tokens, precisions
+
+logging.set_verbosity_error()
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on linux, in bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_time(function, repeat):
+    """Smallest wall time of repeat calls, and the result of the last one."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def tokenize(predictor, text):
+    tokens = predictor.tokenize(text)
+    return tokens, predictor.token_ids(tokens)
+
+
+def detokenize(predictor, tokens, ids, punc_labels, case_labels):
+    detokenizer = Detokenizer(predictor.config.lang)
+    for id, token, punc_label, case_label in zip(ids, tokens, punc_labels, case_labels):
+        if id != predictor.config.cls_token_id and id != predictor.config.sep_token_id:
+            detokenizer.add(token, case_label, punc_label)
+    return detokenizer.take()
+
+
+def run_pipeline(predictor, text, repeat, batch_size):
+    """Time each stage of punctuate() on a text, returning the output text and the timings."""
+    tokenize_time, (tokens, ids) = best_time(lambda: tokenize(predictor, text), repeat)
+    predict_time, [(punc_labels, case_labels)] = best_time(lambda: predictor.predict_labels([ids], batch_size), repeat)
+    detokenize_time, output = best_time(lambda: detokenize(predictor, tokens, ids, punc_labels, case_labels), repeat)
+    num_tokens = len(ids)
+    total_time = tokenize_time + predict_time + detokenize_time
+    return output, {
+        'words': len(text.split()),
+        'tokens': num_tokens,
+        'windows': (num_tokens + predictor.config.max_length - 1) // predictor.config.max_length,
+        'tokenize_tokens_per_second': num_tokens / tokenize_time,
+        'predict_tokens_per_second': num_tokens / predict_time,
+        'detokenize_tokens_per_second': num_tokens / detokenize_time,
+        'tokens_per_second': num_tokens / total_time,
+        'tokenize_ms': tokenize_time * 1000,
+        'predict_ms': predict_time * 1000,
+        'detokenize_ms': detokenize_time * 1000,
+    }
+
+
+def window_latency(predictor, text, repeat):
+    """Latency percentiles of running full windows one at a time, as when streaming."""
+    _, ids = tokenize(predictor, text)
+    max_length = predictor.config.max_length
+    windows = [ids[start: start + max_length] for start in range(0, len(ids), max_length)]
+    # warm up, first calls are slower
+    predictor.run_windows(windows[:1], 1)
+    latencies = []
+    for window in windows * repeat:
+        start = time.perf_counter()
+        predictor.run_windows([window], 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return {
+        'windows': len(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'max_ms': latencies[-1],
+    }
+
+
+def agreement(config, hypothesis, reference):
+    """Punctuation and case agreement of two texts, on their aligned tokens."""
+    hypothesis = list(labeled_tokens(config, hypothesis))
+    reference = list(labeled_tokens(config, reference))
+    matcher = difflib.SequenceMatcher(None, [token for token, _, _ in reference], [token for token, _, _ in hypothesis], autojunk=False)
+    pairs = [(reference[block.a + i], hypothesis[block.b + i]) for block in matcher.get_matching_blocks() for i in range(block.size)]
+    ref_case = [ref[1] for ref, _ in pairs]
+    hyp_case = [hyp[1] for _, hyp in pairs]
+    ref_punc = [ref[2] for ref, _ in pairs]
+    hyp_punc = [hyp[2] for _, hyp in pairs]
+    return {
+        'reference_tokens': len(reference),
+        'aligned_tokens': len(pairs),
+        'punc_fscore': label_fscores(ref_punc, hyp_punc, 'O'),
+        'case_fscore': label_fscores(ref_case, hyp_case, 'LOWER'),
+        'punc_accuracy': sum(r == h for r, h in zip(ref_punc, hyp_punc)) / max(1, len(pairs)),
+        'case_accuracy': sum(r == h for r, h in zip(ref_case, hyp_case)) / max(1, len(pairs)),
+    }
+
+
+def synthetic_text(text, num_words):
+    words = text.split()
+    return ' '.join(words[i % len(words)] for i in range(num_words))
+
+
+def compare(results, baseline, tolerance):
+    """Differences with a previous run, and whether accuracy regressed beyond tolerance."""
+    deltas = {
+        'load_seconds': results['load_seconds'] - baseline['load_seconds'],
+        'peak_memory_mb': results['peak_memory_mb'] - baseline['peak_memory_mb'],
+    }
+    for metric in ['punc_fscore', 'case_fscore']:
+        deltas[metric] = results['accuracy'][metric] - baseline['accuracy'][metric]
+    for name, input in results['inputs'].items():
+        if name in baseline['inputs']:
+            deltas[name + '_tokens_per_second_ratio'] = input['tokens_per_second'] / baseline['inputs'][name]['tokens_per_second']
+    regressed = deltas['punc_fscore'] < -tolerance or deltas['case_fscore'] < -tolerance
+    return deltas, regressed
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    with open(args.input) as fp:
+        text = ' '.join(fp.readlines())
+    with open(args.reference) as fp:
+        reference = fp.read()
+
+    start = time.perf_counter()
+    predictor = CasePuncPredictor(args.checkpoint, lang=args.lang, flavor=args.flavor, device=args.device, precision=args.precision)
+    load_seconds = time.perf_counter() - start
+    load_memory_mb = peak_memory_mb()
+
+    inputs = {}
+    output, inputs['fixture'] = run_pipeline(predictor, text, args.repeat, args.batch_size)
+    for num_words in args.synthetic_words:
+        _, inputs['synthetic_%d' % num_words] = run_pipeline(predictor, synthetic_text(text, num_words), args.repeat, args.batch_size)
+
+    results = {
+        'revision': revision(),
+        'checkpoint': args.checkpoint,
+        'precision': args.precision,
+        'device': str(predictor.config.device),
+        'batch_size': args.batch_size or predictor.config.batch_size,
+        'max_length': predictor.config.max_length,
+        'threads': torch.get_num_threads(),
+        'torch': torch.__version__,
+        'load_seconds': load_seconds,
+        'load_memory_mb': load_memory_mb,
+        'inputs': inputs,
+        'window_latency': window_latency(predictor, text, args.repeat),
+        'accuracy': agreement(predictor.config, output, reference),
+        'peak_memory_mb': peak_memory_mb(),
+    }
+    if torch.cuda.is_available() and predictor.config.device.type == 'cuda':
+        results['peak_cuda_memory_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20
+
+    regressed = False
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            results['baseline'] = args.baseline
+            results['deltas'], regressed = compare(results, json.load(fp), args.tolerance)
+
+    dump = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            fp.write(dump + '\n')
+    print(dump)
+    if regressed:
+        print('ERROR: accuracy dropped by more than %g against %s' % (args.tolerance, args.baseline), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint", help="training checkpoint or exported model directory", type=str)
+    parser.add_argument("--input", help="unpunctuated text", default=os.path.join(here, 'vosk-adapted.txt'), type=str)
+    parser.add_argument("--reference", help="punctuated reference of the input", default=os.path.join(here, 'vosk-adapted.txt.punc'), type=str)
+    parser.add_argument("--lang", help="language (fr, en, zh)", default=default_config.lang, type=str)
+    parser.add_argument("--flavor", help="bert flavor in transformers model zoo", default=default_config.flavor, type=str)
+    parser.add_argument("--device", help="computation device (cuda, cpu)", default='cpu', type=str)
+    parser.add_argument("--precision", help="inference precision (%s)" % ', '.join(precisions), default=default_config.precision, choices=precisions, type=str)
+    parser.add_argument("--batch-size", help="size of batches, defaults to the model's", default=None, type=int)
+    parser.add_argument("--threads", help="number of intra-op threads, 0 for the torch default", default=0, type=int)
+    parser.add_argument("--synthetic-words", help="lengths in words of the synthetic inputs", default=[5000, 50000], type=int, nargs='*')
+    parser.add_argument("--repeat", help="number of timed runs, the best one is reported", default=3, type=int)
+    parser.add_argument("--output", help="write results to this json file", default=None, type=str)
+    parser.add_argument("--baseline", help="results of a previous run to compare to", default=None, type=str)
+    parser.add_argument("--tolerance", help="largest accepted F-score drop against the baseline", default=0.005, type=float)
+    main(parser.parse_args())
@@ -0,0 +1,234 @@
+"""Preparation of training data: punctuated text to labeled tokens and tensors.
+
+Kept out of recasepunc.py so that inference does not import it. The recasepunc command
+line imports it for preprocess and tensorize.
+"""
+import sys
+import os
+import regex as re
+#from mosestokenizer import *
+import unicodedata
+import numpy as np
+
+from recasepunc import Config, init, punctuation, case, mapped_punctuation, lines_per_block, read_blocks, worker_config_args
+
+_worker = None
+
+shard_bytes = 64 * 2 ** 20  # largest input shard tensorized at once
+block_tokens = 2 ** 20  # tokens accumulated in python lists before conversion to arrays
+
+
+def _init_config_worker(config_args):
+    global _worker
+    _worker = Config(**config_args)
+    init(_worker)
+
+
+def label_for_case(token):
+    token = re.sub('[^\p{Han}\p{Ll}\p{Lu}]', '', token)
+    if token == token.lower():
+        return 'LOWER'
+    elif token == token.lower().capitalize():
+        return 'CAPITALIZE'
+    elif token == token.upper():
+        return 'UPPER'
+    else:
+        return 'OTHER'
+
+
+def is_labeled_tsv(input_fn):
+    """Whether a file holds preprocess output (token, case and punctuation columns) rather than raw text."""
+    with open(input_fn) as fp:
+        for line in fp:
+            if line.strip() != '':
+                fields = line.rstrip('\n').split('\t')
+                return len(fields) == 3 and fields[1] in case and fields[2] in punctuation
+    return False
+
+
+def shard_offsets(input_fn, num_shards):
+    """Split a file in byte ranges starting and ending on line boundaries."""
+    size = os.path.getsize(input_fn)
+    offsets = [0]
+    with open(input_fn, 'rb') as fp:
+        for i in range(1, num_shards):
+            fp.seek(max(i * size // num_shards, offsets[-1]))
+            fp.readline()
+            offsets.append(min(fp.tell(), size))
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def read_shard(input_fn, start, end):
+    with open(input_fn, 'rb') as fp:
+        fp.seek(start)
+        while fp.tell() < end:
+            yield fp.readline().decode('utf-8')
+
+
+def tensorize_shard(config, input_fn, start, end, output_prefix, labeled):
+    """Convert a shard of raw text or preprocess output to id and label arrays saved at output_prefix.
+
+    Tokens are converted to arrays every block_tokens tokens so that python lists stay small.
+    """
+    blocks = []
+    tokens = []
+    case_labels = []
+    punc_labels = []
+
+    def flush():
+        X = np.array(config.tokenizer.convert_tokens_to_ids(tokens), dtype=np.int32)
+        if config.debug:
+            assert [token.lower() for token in tokens] == config.tokenizer.convert_ids_to_tokens(X.tolist())
+        Y = np.stack([np.array(punc_labels, dtype=np.uint8), np.array(case_labels, dtype=np.uint8)], axis=1).reshape(-1, 2)
+        blocks.append((X, Y))
+        tokens.clear()
+        case_labels.clear()
+        punc_labels.clear()
+
+    for line in read_shard(input_fn, start, end):
+        if labeled:
+            word, case_label, punc_label = line.strip().split('\t')
+            tokens.append(word)
+            case_labels.append(case[case_label])
+            punc_labels.append(punctuation[punc_label])
+        elif line.strip() != '':
+            for word, case_label, punc_label in labeled_tokens(config, line):
+                tokens.append(word)
+                case_labels.append(case[case_label])
+                punc_labels.append(punctuation[punc_label])
+        if len(tokens) >= block_tokens:
+            flush()
+    flush()
+    X = np.concatenate([X for X, _ in blocks])
+    Y = np.concatenate([Y for _, Y in blocks])
+    np.save(output_prefix + '.x.npy', X)
+    np.save(output_prefix + '.y.npy', Y)
+    return output_prefix, len(X)
+
+
+def _tensorize_shard(args):
+    return tensorize_shard(_worker, *args)
+
+
+def make_tensors(config, input_fn, output_x_fn, output_y_fn):
+    """Tensorize a corpus into numpy arrays of token ids (int32) and punctuation/case labels (uint8).
+
+    The input is either raw punctuated text or the output of preprocess. It is split in
+    shards of at most shard_bytes processed by config.workers processes, the shards are
+    then concatenated into the outputs, which can be memory-mapped with
+    np.load(..., mmap_mode='r'). Memory use is bounded by the shard size whatever the
+    corpus size.
+    """
+    labeled = is_labeled_tsv(input_fn)
+    size = os.path.getsize(input_fn)
+    # at least 8 shards per worker for load balancing, and no shard larger than shard_bytes
+    num_shards = max(1, -(-size // shard_bytes), min(size // 2 ** 20, max(1, config.workers) * 8))
+    shards = [(input_fn, start, end, '%s.shard%d' % (output_x_fn, i), labeled) for i, (start, end) in enumerate(shard_offsets(input_fn, num_shards))]
+    if config.workers > 0:
+        import multiprocessing
+        with multiprocessing.Pool(config.workers, _init_config_worker, (worker_config_args(config),)) as pool:
+            results = pool.map(_tensorize_shard, shards)
+    else:
+        results = [tensorize_shard(config, *shard) for shard in shards]
+
+    size = sum(length for _, length in results)
+    X = np.lib.format.open_memmap(output_x_fn, mode='w+', dtype=np.int32, shape=(size,))
+    Y = np.lib.format.open_memmap(output_y_fn, mode='w+', dtype=np.uint8, shape=(size, 2))
+    offset = 0
+    for prefix, length in results:
+        X[offset: offset + length] = np.load(prefix + '.x.npy')
+        Y[offset: offset + length] = np.load(prefix + '.y.npy')
+        offset += length
+        os.remove(prefix + '.x.npy')
+        os.remove(prefix + '.y.npy')
+    X.flush()
+    Y.flush()
+
+
+def labeled_tokens(config, line):
+    """Tokenize a punctuated line, yielding (lowercased token, case label, punctuation label)."""
+    def process_segment(text, punctuation):
+        text = text.replace('\t', ' ')
+        tokens = config.tokenizer.tokenize(text)
+        for i, token in enumerate(tokens):
+            case_label = label_for_case(token)
+            if i == len(tokens) - 1:
+                yield token.lower(), case_label, punctuation
+            else:
+                yield token.lower(), case_label, 'O'
+
+    line = unicodedata.normalize("NFC", line.strip())
+    start = 0
+    for i, char in enumerate(line):
+        if char in mapped_punctuation:
+            if i > start and line[start: i].strip() != '':
+                yield from process_segment(line[start: i], mapped_punctuation[char])
+            start = i + 1
+    if start < len(line):
+        yield from process_segment(line[start:], 'PERIOD')
+
+
+def preprocess_lines(config, lines):
+    output = []
+    for line in lines:
+        line = line.strip()
+        if line != '':
+            if config.debug:
+                print(line, file=sys.stderr)
+            output.extend('%s\t%s\t%s\n' % labels for labels in labeled_tokens(config, line))
+    return output
+
+
+def _preprocess_lines(lines):
+    return preprocess_lines(_worker, lines)
+
+
+def preprocess_text(config, max_token_count=-1):
+    max_token_count = int(max_token_count)
+    num_tokens_output = 0
+    blocks = read_blocks(sys.stdin, lines_per_block)
+    if config.workers > 0:
+        import multiprocessing
+        pool = multiprocessing.Pool(config.workers, _init_config_worker, (worker_config_args(config),))
+        outputs = pool.imap(_preprocess_lines, blocks)
+    else:
+        pool = None
+        outputs = (preprocess_lines(config, lines) for lines in blocks)
+    try:
+        for output in outputs:
+            if max_token_count > 0 and num_tokens_output + len(output) >= max_token_count:
+                sys.stdout.write(''.join(output[:max_token_count - num_tokens_output]))
+                break
+            sys.stdout.write(''.join(output))
+            num_tokens_output += len(output)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    sys.stdout.flush()
+
+
+def preprocess_text_old_fr(config):
+    assert config.lang == 'fr'
+    splitsents = MosesSentenceSplitter(lang)
+    tokenize = MosesTokenizer(lang, extra=['-no-escape'])
+    normalize = MosesPunctuationNormalizer(lang)
+
+    for line in sys.stdin:
+        if line.strip() != '':
+            for sentence in splitsents([normalize(line)]):
+                tokens = tokenize(sentence)
+                previous_token = None
+                for token in tokens:
+                    if token in mapped_punctuation:
+                        if previous_token != None:
+                            print(previous_token, mapped_punctuation[token], sep='\t')
+                        previous_token = None
+                    elif not re.search('[\p{Han}\p{Ll}\p{Lu}\d]', token): # remove non-alphanumeric tokens
+                        continue
+                    else:
+                        if previous_token != None:
+                            print(previous_token, 'O', sep='\t')
+                        previous_token = token
+                if previous_token != None:
+                    print(previous_token, 'PERIOD', sep='\t')
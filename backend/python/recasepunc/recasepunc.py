@@ -1,20 +1,23 @@
+# only what inference needs is imported here, transformers is imported when a model or
+# tokenizer is loaded, training and preprocessing live in their own modules (see below)
 import sys
 import collections
+import functools
+import importlib
 import os
-import regex as re
-#from mosestokenizer import *
-from tqdm import tqdm
+import pickle
+import types
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.optim as optim
 import random
-import unicodedata
-import numpy as np
 import argparse
-from torch.utils.data import TensorDataset, DataLoader
-
-from transformers import AutoModel, AutoTokenizer, BertTokenizer
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
 
 default_config = argparse.Namespace(
     seed=871253,
@@ -28,6 +31,16 @@ default_config = argparse.Namespace(
     lr=1e-5,
     dab_rate=0.1,
     device='cuda',
+    precision='fp32',
+    workers=0,
+    threads=0,
+    accumulate=1,
+    train_precision='fp32',
+    bert_config=None,
+    student_layers=4,
+    student_width=None,
+    temperature=2.0,
+    distill_alpha=0.5,
     debug=False
 )
 
@@ -62,6 +75,8 @@ def init_random(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
     random.seed(seed)
+    # numpy is already loaded by torch
+    import numpy as np
     np.random.seed(seed)
 
 # NOTE: it is assumed in the implementation that y[:,0] is the punctuation label, and y[:,1] is the case label!
@@ -84,10 +99,63 @@ case = {
 }
 
 
+mapped_punctuation = {
+    '.': 'PERIOD',
+    '...': 'PERIOD',
+    ',': 'COMMA',
+    ';': 'COMMA',
+    ':': 'COMMA',
+    '(': 'COMMA',
+    ')': 'COMMA',
+    '?': 'QUESTION',
+    '!': 'EXCLAMATION',
+    '，': 'COMMA',
+    '！': 'EXCLAMATION',
+    '？': 'QUESTION',
+    '；': 'COMMA',
+    '：': 'COMMA',
+    '（': 'COMMA',
+    '(': 'COMMA',
+    '）': 'COMMA',
+    '［': 'COMMA',
+    '］': 'COMMA',
+    '【': 'COMMA',
+    '】': 'COMMA',
+    '└': 'COMMA',
+    '└ ': 'COMMA',
+    '_': 'O',
+    '。': 'PERIOD',
+    '、': 'COMMA', # enumeration comma
+    '、': 'COMMA',
+    '…': 'PERIOD',
+    '—': 'COMMA',
+    '「': 'COMMA',
+    '」': 'COMMA',
+    '．': 'PERIOD',
+    '《': 'O',
+    '》': 'O',
+    '，': 'COMMA',
+    '“': 'O',
+    '”': 'O',
+    '"': 'O',
+    '-': 'O',
+    '-': 'O',
+    '〉': 'COMMA',
+    '〈': 'COMMA',
+    '↑': 'O',
+    '〔': 'COMMA',
+    '〕': 'COMMA',
+}
+
 class Model(nn.Module):
-    def __init__(self, flavor, device):
+    def __init__(self, flavor, device, bert_config=None):
         super().__init__()
-        self.bert = AutoModel.from_pretrained(flavor)
+        from transformers import AutoConfig, AutoModel
+        if bert_config is None:
+            self.bert = AutoModel.from_pretrained(flavor)
+        else:
+            # architecture only, weights are expected to be loaded afterwards
+            self.bert = AutoModel.from_config(AutoConfig.for_model(**bert_config))
         # need a proper way of determining representation size
         size = self.bert.dim if hasattr(self.bert, 'dim') else self.bert.config.pooler_fc_size if hasattr(self.bert.config, 'pooler_fc_size') else self.bert.config.emb_dim if hasattr(self.bert.config, 'emb_dim') else self.bert.config.hidden_size
         self.punc = nn.Linear(size, 5)
@@ -95,166 +163,177 @@ class Model(nn.Module):
         self.dropout = nn.Dropout(0.3)
         self.to(device)
 
-    def forward(self, x):
-        output = self.bert(x)
-        representations = self.dropout(F.gelu(output['last_hidden_state']))
+    def forward(self, x, attention_mask=None):
+        output = self.bert(x, attention_mask=attention_mask)
+        representations = self.dropout(F.gelu(output[0]))
         punc = self.punc(representations)
         case = self.case(representations)
         return punc, case
 
 
-# randomly create sequences that align to punctuation boundaries
-def drop_at_boundaries(rate, x, y, cls_token_id, sep_token_id, pad_token_id):
-    for i, dropped in enumerate(torch.rand((len(x),)) < rate):
-        if dropped:
-            # select all indices that are sentence endings
-            indices = (y[i,:,0] > 1).nonzero(as_tuple=True)[0]
-            if len(indices) < 2:
-                continue
-            start = indices[0] + 1
-            end = indices[random.randint(1, len(indices) - 1)] + 1
-            length = end - start
-            if length + 2 > len(x[i]):
-                continue
-            x[i, 0] = cls_token_id
-            x[i, 1: length + 1] = x[i, start: end].clone()
-            x[i, length + 1] = sep_token_id
-            x[i, length + 2:] = pad_token_id
-            y[i, 0] = 0
-            y[i, 1: length + 1] = y[i, start: end].clone()
-            y[i, length + 1:] = 0
-
-
-def compute_performance(config, model, loader):
-    device = config.device
-    criterion = nn.CrossEntropyLoss()
-    model.eval()
-    total_loss = all_correct1 = all_correct2 = num_loss = num_perf = 0
-    num_ref = collections.defaultdict(float)
-    num_hyp = collections.defaultdict(float)
-    num_correct = collections.defaultdict(float)
-    for x, y in loader:
-        x = x.long().to(device)
-        y = y.long().to(device)
-        y1 = y[:,:,0]
-        y2 = y[:,:,1]
-        with torch.no_grad():
-            y_scores1, y_scores2 = model(x.to(device))
-            loss1 = criterion(y_scores1.view(y1.size(0) * y1.size(1), -1), y1.view(y1.size(0) * y1.size(1)))
-            loss2 = criterion(y_scores2.view(y2.size(0) * y2.size(1), -1), y2.view(y2.size(0) * y2.size(1)))
-            loss = loss1 + loss2
-            y_pred1 = torch.max(y_scores1, 2)[1]
-            y_pred2 = torch.max(y_scores2, 2)[1]
-            for label in range(1, 5):
-                ref = (y1 == label)
-                hyp = (y_pred1 == label)
-                correct = (ref * hyp == 1)
-                num_ref[label] += ref.sum()
-                num_hyp[label] += hyp.sum()
-                num_correct[label] += correct.sum()
-                num_ref[0] += ref.sum()
-                num_hyp[0] += hyp.sum()
-                num_correct[0] += correct.sum()
-            all_correct1 += (y_pred1 == y1).sum()
-            all_correct2 += (y_pred2 == y2).sum()
-            total_loss += loss.item()
-            num_loss += len(y)
-            num_perf += len(y) * config.max_length 
-    recall = {}
-    precision = {}
-    fscore = {}
-    for label in range(0, 5):
-        recall[label] = num_correct[label] / num_ref[label] if num_ref[label] > 0 else 0
-        precision[label] = num_correct[label] / num_hyp[label] if num_hyp[label] > 0 else 0
-        fscore[label] = (2 * recall[label] * precision[label] / (recall[label] + precision[label])).item() if recall[label] + precision[label] > 0 else 0
-    return total_loss / num_loss, all_correct2.item() / num_perf, all_correct1.item() / num_perf, fscore
-
-
-def fit(config, model, checkpoint_path, train_loader, valid_loader, iterations, valid_period=200, lr=1e-5):
-    device = config.device
-    criterion = nn.CrossEntropyLoss()
-    optimizer = optim.Adam(filter(lambda param: param.requires_grad, model.parameters()), lr=lr)
-    iteration = 0
-    while True:
-        model.train()
-        total_loss = num = 0
-        for x, y in tqdm(train_loader):
-            x = x.long().to(device)
-            y = y.long().to(device)
-            drop_at_boundaries(config.dab_rate, x, y, config.cls_token_id, config.sep_token_id, config.pad_token_id)
-            y1 = y[:,:,0]
-            y2 = y[:,:,1]
-            optimizer.zero_grad()
-            y_scores1, y_scores2 = model(x)
-            loss1 = criterion(y_scores1.view(y1.size(0) * y1.size(1), -1), y1.view(y1.size(0) * y1.size(1)))
-            loss2 = criterion(y_scores2.view(y2.size(0) * y2.size(1), -1), y2.view(y2.size(0) * y2.size(1)))
-            loss = loss1 + loss2
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item()
-            num += len(y)
-            if iteration % valid_period == valid_period - 1:
-                train_loss = total_loss / num
-                valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore = compute_performance(config, model, valid_loader)
-                torch.save({
-                    'iteration': iteration + 1,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'train_loss': train_loss,
-                    'valid_loss': valid_loss,
-                    'valid_accuracy_case': valid_accuracy_case,
-                    'valid_accuracy_punc': valid_accuracy_punc,
-                    'valid_fscore': valid_fscore,
-                    'config': config.__dict__,
-                }, '%s.%d' % (checkpoint_path, iteration + 1))
-                print(iteration + 1, train_loss, valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore)
-                total_loss = num = 0
-
-            iteration += 1
-            if iteration > iterations:
-                return
-
-            sys.stderr.flush()
-            sys.stdout.flush()
-
-
-def batchify(max_length, x, y):
-    print (x.shape)
-    print (y.shape)
-    x = x[:(len(x) // max_length) * max_length].reshape(-1, max_length)
-    y = y[:(len(y) // max_length) * max_length, :].reshape(-1, max_length, 2)
-    return x, y
-
-
-def train(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path):
-    X_train, Y_train = batchify(config.max_length, torch.load(train_x_fn), torch.load(train_y_fn))
-    X_valid, Y_valid = batchify(config.max_length, torch.load(valid_x_fn), torch.load(valid_y_fn))
+precisions = ['fp32', 'int8', 'bf16']
 
-    train_set = TensorDataset(X_train, Y_train)
-    valid_set = TensorDataset(X_valid, Y_valid)
 
-    train_loader = DataLoader(train_set, batch_size=config.batch_size, shuffle=True)
-    valid_loader = DataLoader(valid_set, batch_size=config.batch_size)
+def bf16_supported():
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
 
-    model = Model(config.flavor, config.device)
 
-    fit(config, model, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr)
+class Bf16Model(nn.Module):
+    """Runs a model under CPU bf16 autocast, returning fp32 scores."""
 
-
-def run_eval(config, test_x_fn, test_y_fn, checkpoint_path):
-    X_test, Y_test = batchify(config.max_length, torch.load(test_x_fn), torch.load(test_y_fn))
-    test_set = TensorDataset(X_test, Y_test)
-    test_loader = DataLoader(test_set, batch_size=config.batch_size)
-
-    loaded = torch.load(checkpoint_path, map_location=config.device)
-    if 'config' in loaded:
-        config = Config(**loaded['config'])
-        init(config)
-
-    model = Model(config.flavor, config.device)
-    model.load_state_dict(loaded['model_state_dict'])
-
-    print(*compute_performance(config, model, test_loader))
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, attention_mask=None):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            punc, case = self.model(x, attention_mask)
+        return punc.float(), case.float()
+
+
+def set_precision(model, precision, device):
+    """Convert a trained model for inference at the given precision (fp32, int8 or bf16).
+
+    int8 applies dynamic quantization to all linear layers, bf16 wraps the model in CPU
+    autocast. Both are CPU only, other devices keep running in fp32. TorchScript graphs
+    keep the precision they were exported with.
+    """
+    assert precision in precisions
+    if precision == 'fp32':
+        return model
+    if isinstance(model, torch.jit.ScriptModule):
+        print('WARNING: precision of a torchscript model is set at export time, ignoring %s' % precision, file=sys.stderr)
+        return model
+    if torch.device(device).type != 'cpu':
+        print('WARNING: %s inference is only supported on cpu, using fp32' % precision, file=sys.stderr)
+        return model
+    if precision == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if not bf16_supported():
+        print('WARNING: bf16 is not supported by this cpu, using fp32', file=sys.stderr)
+        return model
+    return Bf16Model(model)
+
+
+def run_windows(model, windows, pad_token_id, device, batch_size):
+    """Predict punctuation and case labels for a list of token id windows of any length.
+
+    Windows are bucketed by length and each batch is only padded up to its longest window,
+    with an attention mask over the padding, so short inputs cost little. Labels are
+    returned as (punc_labels, case_labels) lists, in the order of the input windows.
+    """
+    results = [None] * len(windows)
+    order = sorted(range(len(windows)), key=lambda i: len(windows[i]))
+    for batch_start in range(0, len(order), batch_size):
+        batch = order[batch_start: batch_start + batch_size]
+        length = max(len(windows[i]) for i in batch)
+        x = torch.full((len(batch), length), pad_token_id, dtype=torch.long)
+        mask = torch.zeros(len(batch), length, dtype=torch.long)
+        for row, i in enumerate(batch):
+            x[row, :len(windows[i])] = torch.tensor(windows[i], dtype=torch.long)
+            mask[row, :len(windows[i])] = 1
+        with torch.inference_mode():
+            y_scores1, y_scores2 = model(x.to(device), mask.to(device))
+            y_pred1 = torch.max(y_scores1, 2)[1].tolist()
+            y_pred2 = torch.max(y_scores2, 2)[1].tolist()
+        for row, i in enumerate(batch):
+            results[i] = (y_pred1[row][:len(windows[i])], y_pred2[row][:len(windows[i])])
+    return results
+
+
+class MicroBatcher:
+    """Packs windows submitted concurrently by many threads into shared forward passes.
+
+    A single worker thread owns the model. It takes the first pending request, keeps
+    collecting requests until max_batch_size windows are queued or max_wait_ms has
+    elapsed, runs them together and hands each caller back its own labels. max_wait_ms
+    therefore bounds the queueing delay added to every request. Once closed, submit
+    raises and requests still queued fail with RuntimeError instead of waiting forever.
+    """
+
+    def __init__(self, model, pad_token_id, device, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name='recasepunc-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, windows):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('MicroBatcher is closed')
+            self.queue.put((windows, future))
+        return future
+
+    def run(self, windows):
+        return self.submit(windows).result()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+
+    def _loop(self):
+        try:
+            self._batch_requests()
+        finally:
+            # fail whatever the loop left behind so that no caller waits on it
+            while True:
+                try:
+                    request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request[1].set_exception(RuntimeError('MicroBatcher is closed'))
+
+    def _batch_requests(self):
+        running = True
+        while running:
+            request = self.queue.get()
+            if request is None:
+                break
+            requests = [request]
+            num_windows = len(request[0])
+            deadline = time.monotonic() + self.max_wait
+            while num_windows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                requests.append(request)
+                num_windows += len(request[0])
+            self._run_batch(requests)
+
+    def _run_batch(self, requests):
+        windows = [window for request_windows, future in requests for window in request_windows]
+        try:
+            results = run_windows(self.model, windows, self.pad_token_id, self.device, self.max_batch_size)
+        except Exception as e:
+            for request_windows, future in requests:
+                future.set_exception(e)
+            return
+        offset = 0
+        for request_windows, future in requests:
+            future.set_result(results[offset: offset + len(request_windows)])
+            offset += len(request_windows)
 
 
 def recase(token, label):
@@ -268,54 +347,259 @@ def recase(token, label):
         return token
 
 
-class CasePuncPredictor:
-    def __init__(self, checkpoint_path, lang=default_config.lang, flavor=default_config.flavor, device=default_config.device):
-        loaded = torch.load(checkpoint_path, map_location=device if torch.cuda.is_available() else 'cpu')
-        if 'config' in loaded:
-            self.config = Config(**loaded['config'])
+class Detokenizer:
+    """Joins predicted tokens back into text, in linear time.
+
+    Tokens can be added in several rounds, take() returns the text produced since the
+    previous call. Word pieces are glued to the preceding token, either as ## continuations
+    or, for Flaubert, as pieces preceding a </w> word end. Apostrophes are not spaced.
+    """
+
+    def __init__(self, lang):
+        self.end_of_word_pieces = lang == 'fr'
+        self.parts = []
+        self.last_char = None
+        self.was_word = False
+
+    def add(self, token, case_label, punc_label):
+        if self.end_of_word_pieces:
+            # different strategy due to sub-lexical token encoding in Flaubert
+            if token.endswith('</w>'):
+                text = recase(token[:-4], case_label) + punctuation_syms[punc_label]
+            else:
+                text = recase(token, case_label)
+            space = self.was_word
+            self.was_word = token.endswith('</w>')
         else:
-            self.config = Config(lang=lang, flavor=flavor, device=device)
-        init(self.config)
+            if token.startswith('##'):
+                text = recase(token[2:], case_label) + punctuation_syms[punc_label]
+            else:
+                text = recase(token, case_label) + punctuation_syms[punc_label]
+            space = self.last_char is not None and not token.startswith('#') and not token.startswith("'") and self.last_char != "'"
+        if space:
+            self.parts.append(' ')
+        if text != '':
+            self.parts.append(text)
+            self.last_char = text[-1]
+        elif self.last_char is None:
+            self.last_char = ''
+
+    def take(self):
+        text = ''.join(self.parts)
+        self.parts = []
+        return text
+
+
+exported_config_keys = ['seed', 'lang', 'flavor', 'max_length', 'batch_size']
+export_formats = ['safetensors', 'torchscript']
+
+
+def export_model(config, checkpoint_path, output_dir, format='safetensors'):
+    """Write an inference artifact: weights or a compiled graph, config and tokenizer files.
+
+    safetensors writes the weights only, without optimizer state, and can be loaded with
+    load_model without fetching the pretrained encoder weights. torchscript writes a traced,
+    frozen graph of the whole model that runs without the transformers modeling code.
+    """
+    assert format in export_formats
+    precision = config.precision
+    config, model = load_model(checkpoint_path, config)
+    os.makedirs(output_dir, exist_ok=True)
+    if format == 'safetensors':
+        from safetensors.torch import save_file
+
+        # non-persistent buffers are exported too, so that loading never needs to initialize anything
+        tensors = dict(model.named_parameters())
+        tensors.update(model.named_buffers())
+        save_file({name: tensor.detach().contiguous().cpu() for name, tensor in tensors.items()}, os.path.join(output_dir, 'model.safetensors'))
+    else:
+        trace_model(set_precision(model, precision, config.device), config).save(os.path.join(output_dir, 'model.ts'))
+    config.tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, 'config.json'), 'w') as fp:
+        json.dump({
+            'config': {key: getattr(config, key) for key in exported_config_keys},
+            'bert_config': model.bert.config.to_dict(),
+        }, fp, indent=2)
+
+
+def trace_model(model, config):
+    """Trace the model into a frozen TorchScript graph optimized for inference.
+
+    Sequence length and batch size stay dynamic, the graph takes (ids, attention_mask).
+    """
+    for module in model.modules():
+        if isinstance(module, Model):
+            module.bert.config.return_dict = False
+    x = torch.full((2, 16), config.pad_token_id, dtype=torch.long, device=config.device)
+    mask = torch.ones_like(x)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, (x, mask))
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+def load_exported_model(path, bert_config, device):
+    from safetensors.torch import load_file
+
+    # build on the meta device so that no weights get allocated or initialized, then adopt
+    # the tensors of the memory-mapped file, which are shared by all processes loading it
+    with torch.device('meta'):
+        model = Model(None, 'meta', bert_config=bert_config)
+    tensors = load_file(os.path.join(path, 'model.safetensors'), device=str(device))
+    persistent = model.state_dict().keys()
+    model.load_state_dict({name: tensors[name] for name in persistent}, assign=True)
+    for name, tensor in tensors.items():
+        if name not in persistent:
+            module_name, _, buffer_name = name.rpartition('.')
+            model.get_submodule(module_name)._buffers[buffer_name] = tensor
+    return model
+
+
+class CheckpointUnpickler(pickle.Unpickler):
+    """Resolves classes pickled from the command line, where this module runs as __main__.
+
+    Training checkpoints carry the config, including the tokenizer and its patched
+    WordpieceTokenizer or bpe cache, which then reference __main__ rather than recasepunc
+    and could only be loaded by recasepunc.py itself.
+    """
+
+    def find_class(self, module, name):
+        this_module = sys.modules[__name__]
+        if module == '__main__' and hasattr(this_module, name):
+            return getattr(this_module, name)
+        return super().find_class(module, name)
+
+
+checkpoint_pickle_module = types.ModuleType('recasepunc_pickle')
+checkpoint_pickle_module.Unpickler = CheckpointUnpickler
+checkpoint_pickle_module.load = lambda fp, **kwargs: CheckpointUnpickler(fp, **kwargs).load()
+
+
+def load_checkpoint(checkpoint_path, map_location):
+    # checkpoints hold the pickled config and tokenizer, not only weights
+    return torch.load(checkpoint_path, map_location=map_location, pickle_module=checkpoint_pickle_module, weights_only=False)
+
+
+def load_model(checkpoint_path, config):
+    """Load a model for inference from a training checkpoint or a directory written by export.
+
+    Returns the initialized config the model was trained with, falling back to the given
+    config for checkpoints that do not carry one, and the model in eval mode. Directories
+    holding a TorchScript graph yield the graph, which is called like the model.
+    """
+    if os.path.isdir(checkpoint_path):
+        with open(os.path.join(checkpoint_path, 'config.json')) as fp:
+            exported = json.load(fp)
+        config = Config(**dict(exported['config'], flavor=checkpoint_path, device=config.device))
+        init(config)
+        if os.path.exists(os.path.join(checkpoint_path, 'model.ts')):
+            return config, torch.jit.load(os.path.join(checkpoint_path, 'model.ts'), map_location=config.device)
+        model = load_exported_model(checkpoint_path, exported['bert_config'], config.device)
+    else:
+        loaded = load_checkpoint(checkpoint_path, config.device if torch.cuda.is_available() else 'cpu')
+        if 'config' in loaded:
+            config = Config(**loaded['config'])
+        init(config)
+        model = Model(config.flavor, config.device, config.bert_config)
+        model.load_state_dict(loaded['model_state_dict'])
+    model.eval()
+    return config, model
+
 
-        self.model = Model(self.config.flavor, self.config.device)
-        self.model.load_state_dict(loaded['model_state_dict'])
-        self.model.eval()
-        self.model.to(self.config.device)
+class CasePuncPredictor:
+    def __init__(self, checkpoint_path, lang=default_config.lang, flavor=default_config.flavor, device=default_config.device, precision=default_config.precision):
+        self.config, self.model = load_model(checkpoint_path, Config(lang=lang, flavor=flavor, device=device))
+        self.model = set_precision(self.model, precision, self.config.device)
+        self.config.precision = precision
 
         self.rev_case = {b: a for a, b in case.items()}
         self.rev_punc = {b: a for a, b in punctuation.items()}
+        self.batcher = None
+
+    def start_batching(self, max_batch_size=32, max_wait_ms=5):
+        """Share forward passes between threads calling predict concurrently."""
+        self.stop_batching()
+        self.batcher = MicroBatcher(self.model, self.config.pad_token_id, self.config.device, max_batch_size, max_wait_ms)
+
+    def stop_batching(self):
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+    def run_windows(self, windows, batch_size=None):
+        if self.batcher is not None:
+            return self.batcher.run(windows)
+        return run_windows(self.model, windows, self.config.pad_token_id, self.config.device, batch_size or self.config.batch_size)
 
     def tokenize(self, text):
         return [self.config.cls_token] + self.config.tokenizer.tokenize(text) + [self.config.sep_token]
 
-    def predict(self, tokens, getter=lambda x: x):
+    def token_ids(self, tokens, getter=lambda x: x):
+        if len(tokens) > 0 and type(getter(tokens[0])) == str:
+            return self.config.tokenizer.convert_tokens_to_ids([getter(token) for token in tokens])
+        return [getter(token) for token in tokens]
+
+    def predict_labels(self, documents, batch_size=None):
+        """Punctuation and case labels of token id sequences (cls ... sep), as lists of label ids.
+
+        The windows of all documents are run through the model together. Words following a
+        sentence end are capitalized and the last word of each document ends a sentence.
+        """
         max_length = self.config.max_length
-        device = self.config.device
+        windows = [ids[start: start + max_length] for ids in documents for start in range(0, len(ids), max_length)]
+        predictions = iter(self.run_windows(windows, batch_size))
+        results = []
+        for ids in documents:
+            punc_labels = []
+            case_labels = []
+            for start in range(0, len(ids), max_length):
+                y_pred1, y_pred2 = next(predictions)
+                punc_labels.extend(y_pred1)
+                case_labels.extend(y_pred2)
+            self.fix_labels(ids, punc_labels, case_labels)
+            results.append((punc_labels, case_labels))
+        return results
+
+    def fix_labels(self, ids, punc_labels, case_labels, previous_label=punctuation['PERIOD'], end_of_text=True):
+        for i, id in enumerate(ids):
+            if id == self.config.cls_token_id or id == self.config.sep_token_id:
+                continue
+            if previous_label != None and previous_label > 1:
+                if case_labels[i] in [case['LOWER'], case['OTHER']]: # LOWER, OTHER
+                    case_labels[i] = case['CAPITALIZE']
+            if end_of_text and i == len(ids) - 2 and punc_labels[i] == punctuation['O']:
+                punc_labels[i] = punctuation['PERIOD']
+            previous_label = punc_labels[i]
+        return previous_label
+
+    def predict(self, tokens, getter=lambda x: x, batch_size=None):
         if type(tokens) == str:
             tokens = self.tokenize(tokens)
-        previous_label = punctuation['PERIOD']
-        for start in range(0, len(tokens), max_length):
-            instance = tokens[start: start + max_length]
-            if type(getter(instance[0])) == str:
-                ids = self.config.tokenizer.convert_tokens_to_ids(getter(token) for token in instance)
-            else:
-                ids = [getter(token) for token in instance]
-            if len(ids) < max_length:
-                ids += [0] * (max_length - len(ids))
-            x = torch.tensor([ids]).long().to(device)
-            y_scores1, y_scores2 = self.model(x)
-            y_pred1 = torch.max(y_scores1, 2)[1]
-            y_pred2 = torch.max(y_scores2, 2)[1]
-            for i, id, token, punc_label, case_label in zip(range(len(instance)), ids, instance, y_pred1[0].tolist()[:len(instance)], y_pred2[0].tolist()[:len(instance)]):
-                if id == self.config.cls_token_id or id == self.config.sep_token_id:
-                    continue
-                if previous_label != None and previous_label > 1:
-                    if case_label in [case['LOWER'], case['OTHER']]: # LOWER, OTHER
-                        case_label = case['CAPITALIZE']
-                if i + start == len(tokens) - 2 and punc_label == punctuation['O']:
-                    punc_label = punctuation['PERIOD']
-                yield (token, self.rev_case[case_label], self.rev_punc[punc_label])
-                previous_label = punc_label
+        ids = self.token_ids(tokens, getter)
+        [(punc_labels, case_labels)] = self.predict_labels([ids], batch_size)
+        for id, token, punc_label, case_label in zip(ids, tokens, punc_labels, case_labels):
+            if id == self.config.cls_token_id or id == self.config.sep_token_id:
+                continue
+            yield (token, self.rev_case[case_label], self.rev_punc[punc_label])
+
+    def stream(self, context=32, lookahead=16):
+        """Start a session recasing text that arrives fragment by fragment, see StreamingSession."""
+        return StreamingSession(self, context, lookahead)
+
+    def punctuate(self, text, batch_size=None):
+        """Restore case and punctuation of a text, returning the finished string."""
+        return self.punctuate_many([text], batch_size)[0]
+
+    def punctuate_many(self, texts, batch_size=None):
+        documents = [self.tokenize(text) for text in texts]
+        documents_ids = [self.token_ids(tokens) for tokens in documents]
+        results = []
+        for tokens, ids, (punc_labels, case_labels) in zip(documents, documents_ids, self.predict_labels(documents_ids, batch_size)):
+            detokenizer = Detokenizer(self.config.lang)
+            for id, token, punc_label, case_label in zip(ids, tokens, punc_labels, case_labels):
+                if id != self.config.cls_token_id and id != self.config.sep_token_id:
+                    detokenizer.add(token, case_label, punc_label)
+            results.append(detokenizer.take())
+        return results
 
     def map_case_label(self, token, case_label):
         if token.endswith('</w>'):
@@ -332,224 +616,174 @@ class CasePuncPredictor:
         return token + punctuation_syms[punctuation[punc_label]]
 
 
-
-def generate_predictions(config, checkpoint_path):
-    loaded = torch.load(checkpoint_path, map_location=config.device if torch.cuda.is_available() else 'cpu')
-    if 'config' in loaded:
-        config = Config(**loaded['config'])
-        init(config)
-
-    model = Model(config.flavor, config.device)
-    model.load_state_dict(loaded['model_state_dict'])
-
-    rev_case = {b: a for a, b in case.items()}
-    rev_punc = {b: a for a, b in punctuation.items()}
-
-    for line in sys.stdin:
+class StreamingSession:
+    """Recases and punctuates a text that arrives in fragments, such as chunk transcripts.
+
+    Fragments are expected to split the text between words. A token is finalized once
+    lookahead more tokens have been seen after it, so that the model had some right
+    context; finalized text is returned by feed() as soon as it is stable. Each call only
+    runs the model on the pending tokens preceded by the last context finalized ones, and
+    the label state (sentence starts) and the detokenizer carry across fragments.
+    Concatenating the results of all feed() calls and flush() gives the full text.
+    """
+
+    def __init__(self, predictor, context=32, lookahead=16):
+        self.predictor = predictor
+        self.config = predictor.config
+        self.context = context
+        self.lookahead = lookahead
+        self.window_size = self.config.max_length - 2 - context
+        assert 0 <= lookahead < self.window_size
+        self.context_ids = []
+        self.pending_tokens = []
+        self.pending_ids = []
+        self.previous_label = punctuation['PERIOD']
+        self.detokenizer = Detokenizer(self.config.lang)
+
+    def feed(self, text):
+        tokens = self.config.tokenizer.tokenize(text)
+        self.pending_tokens.extend(tokens)
+        self.pending_ids.extend(self.predictor.token_ids(tokens))
+        return self._finalize(end_of_text=False)
+
+    def flush(self):
+        return self._finalize(end_of_text=True)
+
+    def _finalize(self, end_of_text):
+        while len(self.pending_ids) > (0 if end_of_text else self.lookahead):
+            ids = self.pending_ids[:self.window_size]
+            window = [self.config.cls_token_id] + self.context_ids + ids + [self.config.sep_token_id]
+            [(punc_labels, case_labels)] = self.predictor.run_windows([window])
+            offset = 1 + len(self.context_ids)
+            last = end_of_text and len(ids) == len(self.pending_ids)
+            num_final = len(ids) if last else len(ids) - self.lookahead
+            # the separator keeps fix_labels aligned on where the text ends
+            ids = ids[:num_final] + [self.config.sep_token_id]
+            punc_labels = punc_labels[offset: offset + num_final] + [punctuation['O']]
+            case_labels = case_labels[offset: offset + num_final] + [case['LOWER']]
+            self.previous_label = self.predictor.fix_labels(ids, punc_labels, case_labels, self.previous_label, last)
+            for token, punc_label, case_label in zip(self.pending_tokens, punc_labels[:num_final], case_labels[:num_final]):
+                self.detokenizer.add(token, case_label, punc_label)
+            self.context_ids = (self.context_ids + ids[:num_final])[-self.context:] if self.context > 0 else []
+            del self.pending_tokens[:num_final]
+            del self.pending_ids[:num_final]
+        return self.detokenizer.take()
+
+
+lines_per_block = 1024
+
+
+def format_prediction(config, tokens, ids, punc_labels, case_labels):
+    """Output line of the predict action for one tokenized input line."""
+    output = []
+    previous_label = punctuation['PERIOD']
+    first_time = True
+    was_word = False
+    for id, token, punc_label, case_label in zip(ids, tokens, punc_labels, case_labels):
+        if config.debug:
+            print(id, token, punc_label, case_label, file=sys.stderr)
+        if id == config.cls_token_id or id == config.sep_token_id:
+            continue
+        if previous_label != None and previous_label > 1:
+            if case_label in [case['LOWER'], case['OTHER']]:
+                case_label = case['CAPITALIZE']
+        previous_label = punc_label
+        # different strategy due to sub-lexical token encoding in Flaubert
+        if config.lang == 'fr':
+            if was_word:
+                output.append(' ')
+            if token.endswith('</w>'):
+                output.append(recase(token[:-4], case_label) + punctuation_syms[punc_label])
+                was_word = True
+            else:
+                output.append(recase(token, case_label))
+                was_word = False
+        else:
+            if token.startswith('##'):
+                output.append(recase(token[2:], case_label))
+            else:
+                if not first_time:
+                    output.append(' ')
+                first_time = False
+                output.append(recase(token, case_label) + punctuation_syms[punc_label])
+    if previous_label == 0:
+        output.append('.')
+    return ''.join(output)
+
+
+def predict_lines(config, model, lines):
+    """Recase and punctuate a block of input lines, with the windows of all lines batched together."""
+    documents = []
+    for line in lines:
         # also drop punctuation that we may generate
         line = ''.join([c for c in line if c not in mapped_punctuation])
-        if config.debug:
-            print(line)
         tokens = [config.cls_token] + config.tokenizer.tokenize(line) + [config.sep_token]
         if config.debug:
-            print(tokens)
-        previous_label = punctuation['PERIOD']
-        first_time = True
-        was_word = False
-        for start in range(0, len(tokens), config.max_length):
-            instance = tokens[start: start + config.max_length]
-            ids = config.tokenizer.convert_tokens_to_ids(instance)
-            #print(len(ids), file=sys.stderr)
-            if len(ids) < config.max_length:
-                ids += [config.pad_token_id] * (config.max_length - len(ids))
-            x = torch.tensor([ids]).long().to(config.device)
-            y_scores1, y_scores2 = model(x)
-            y_pred1 = torch.max(y_scores1, 2)[1]
-            y_pred2 = torch.max(y_scores2, 2)[1]
-            for id, token, punc_label, case_label in zip(ids, instance, y_pred1[0].tolist()[:len(instance)], y_pred2[0].tolist()[:len(instance)]):
-                if config.debug:
-                    print(id, token, punc_label, case_label, file=sys.stderr)
-                if id == config.cls_token_id or id == config.sep_token_id:
-                    continue
-                if previous_label != None and previous_label > 1:
-                    if case_label in [case['LOWER'], case['OTHER']]:
-                        case_label = case['CAPITALIZE']
-                previous_label = punc_label
-                # different strategy due to sub-lexical token encoding in Flaubert
-                if config.lang == 'fr':
-                    if token.endswith('</w>'):
-                        cased_token = recase(token[:-4], case_label)
-                        if was_word:
-                            print(' ', end='')
-                        print(cased_token + punctuation_syms[punc_label], end='')
-                        was_word = True
-                    else:
-                        cased_token = recase(token, case_label)
-                        if was_word:
-                            print(' ', end='')
-                        print(cased_token, end='')
-                        was_word = False
-                else:
-                    if token.startswith('##'):
-                        cased_token = recase(token[2:], case_label)
-                        print(cased_token, end='')
-                    else:
-                        cased_token = recase(token, case_label)
-                        if not first_time:
-                            print(' ', end='')
-                        first_time = False
-                        print(cased_token + punctuation_syms[punc_label], end='')
-        if previous_label == 0:
-            print('.', end='')
-        print()
-
-
-def label_for_case(token):
-    token = re.sub('[^\p{Han}\p{Ll}\p{Lu}]', '', token)
-    if token == token.lower():
-        return 'LOWER'
-    elif token == token.lower().capitalize():
-        return 'CAPITALIZE'
-    elif token == token.upper():
-        return 'UPPER'
-    else:
-        return 'OTHER'
+            print(line, tokens, file=sys.stderr)
+        documents.append((tokens, config.tokenizer.convert_tokens_to_ids(tokens)))
+    windows = [ids[start: start + config.max_length] for tokens, ids in documents for start in range(0, len(ids), config.max_length)]
+    predictions = iter(run_windows(model, windows, config.pad_token_id, config.device, config.batch_size))
+    output = []
+    for tokens, ids in documents:
+        punc_labels = []
+        case_labels = []
+        for start in range(0, len(ids), config.max_length):
+            y_pred1, y_pred2 = next(predictions)
+            punc_labels.extend(y_pred1)
+            case_labels.extend(y_pred2)
+        output.append(format_prediction(config, tokens, ids, punc_labels, case_labels) + '\n')
+    return ''.join(output)
+
+
+def read_blocks(fp, num_lines):
+    while True:
+        lines = list(itertools.islice(fp, num_lines))
+        if len(lines) == 0:
+            return
+        yield lines
 
 
-def make_tensors(config, input_fn, output_x_fn, output_y_fn):
-    # count file lines without loading them
-    size = 0
-    with open(input_fn) as fp:
-        for line in fp:
-            size += 1
+_worker = None
 
-    with open(input_fn) as fp:
-        X = torch.IntTensor(size)
-        Y = torch.ByteTensor(size, 2)
 
-        offset = 0
-        for n, line in enumerate(fp):
-            word, case_label, punc_label = line.strip().split('\t')
-            id = config.tokenizer.convert_tokens_to_ids(word)
-            if config.debug:
-                assert word.lower() == tokenizer.convert_ids_to_tokens(id)
-            X[offset] = id
-            Y[offset, 0] = punctuation[punc_label]
-            Y[offset, 1] = case[case_label]
-            offset += 1
+def worker_config_args(config):
+    """Picklable arguments to rebuild the config in a worker process, which then calls init itself."""
+    config_args = {key: getattr(config, key) for key in default_config.__dict__}
+    config_args['device'] = str(config.device)
+    return config_args
 
-        torch.save(X, output_x_fn)
-        torch.save(Y, output_y_fn)
 
+def _init_predict_worker(config_args, checkpoint_path, num_threads):
+    global _worker
+    torch.set_num_threads(num_threads)
+    config = Config(**config_args)
+    precision = config.precision
+    config, model = load_model(checkpoint_path, config)
+    _worker = (config, set_precision(model, precision, config.device))
 
-mapped_punctuation = {
-    '.': 'PERIOD',
-    '...': 'PERIOD',
-    ',': 'COMMA',
-    ';': 'COMMA',
-    ':': 'COMMA',
-    '(': 'COMMA',
-    ')': 'COMMA',
-    '?': 'QUESTION',
-    '!': 'EXCLAMATION',
-    '，': 'COMMA',
-    '！': 'EXCLAMATION',
-    '？': 'QUESTION',
-    '；': 'COMMA',
-    '：': 'COMMA',
-    '（': 'COMMA',
-    '(': 'COMMA',
-    '）': 'COMMA',
-    '［': 'COMMA',
-    '］': 'COMMA',
-    '【': 'COMMA',
-    '】': 'COMMA',
-    '└': 'COMMA',
-    '└ ': 'COMMA',
-    '_': 'O',
-    '。': 'PERIOD',
-    '、': 'COMMA', # enumeration comma
-    '、': 'COMMA',
-    '…': 'PERIOD',
-    '—': 'COMMA',
-    '「': 'COMMA',
-    '」': 'COMMA',
-    '．': 'PERIOD',
-    '《': 'O',
-    '》': 'O',
-    '，': 'COMMA',
-    '“': 'O',
-    '”': 'O',
-    '"': 'O',
-    '-': 'O',
-    '-': 'O',
-    '〉': 'COMMA',
-    '〈': 'COMMA',
-    '↑': 'O',
-    '〔': 'COMMA',
-    '〕': 'COMMA',
-}
 
-def preprocess_text(config, max_token_count=-1):
-    global num_tokens_output
-    max_token_count = int(max_token_count)
-    num_tokens_output = 0
-    def process_segment(text, punctuation):
-        global num_tokens_output
-        text = text.replace('\t', ' ')
-        tokens = config.tokenizer.tokenize(text)
-        for i, token in enumerate(tokens):
-            case_label = label_for_case(token)
-            if i == len(tokens) - 1:
-                print(token.lower(), case_label, punctuation, sep='\t')
-            else:
-                print(token.lower(), case_label, 'O', sep='\t')
-            num_tokens_output += 1
-            # a bit too ugly, but alternative is to throw an exception
-            if max_token_count > 0 and num_tokens_output >= max_token_count:
-                sys.exit(0)
-
-    for line in sys.stdin:
-        line = line.strip()
-        if line != '':
-            line = unicodedata.normalize("NFC", line)
-            if config.debug:
-                print(line)
-            start = 0
-            for i, char in enumerate(line):
-                if char in mapped_punctuation:
-                    if i > start and line[start: i].strip() != '':
-                        process_segment(line[start: i], mapped_punctuation[char])
-                    start = i + 1
-            if start < len(line):
-                process_segment(line[start:], 'PERIOD')
-
-
-def preprocess_text_old_fr(config):
-    assert config.lang == 'fr'
-    splitsents = MosesSentenceSplitter(lang)
-    tokenize = MosesTokenizer(lang, extra=['-no-escape'])
-    normalize = MosesPunctuationNormalizer(lang)
-
-    for line in sys.stdin:
-        if line.strip() != '':
-            for sentence in splitsents([normalize(line)]):
-                tokens = tokenize(sentence)
-                previous_token = None
-                for token in tokens:
-                    if token in mapped_punctuation:
-                        if previous_token != None:
-                            print(previous_token, mapped_punctuation[token], sep='\t')
-                        previous_token = None
-                    elif not re.search('[\p{Han}\p{Ll}\p{Lu}\d]', token): # remove non-alphanumeric tokens
-                        continue
-                    else:
-                        if previous_token != None:
-                            print(previous_token, 'O', sep='\t')
-                        previous_token = token
-                if previous_token != None:
-                    print(previous_token, 'PERIOD', sep='\t')
-            
+def _predict_block(lines):
+    return predict_lines(*_worker, lines)
+
+
+def generate_predictions(config, checkpoint_path):
+    if config.workers > 0:
+        # each worker process loads its own model, blocks of lines are dealt out and written back in order
+        import multiprocessing
+        num_threads = max(1, torch.get_num_threads() // config.workers)
+        with multiprocessing.Pool(config.workers, _init_predict_worker, (worker_config_args(config), checkpoint_path, num_threads)) as pool:
+            for output in pool.imap(_predict_block, read_blocks(sys.stdin, lines_per_block)):
+                sys.stdout.write(output)
+        sys.stdout.flush()
+        return
+
+    precision = config.precision
+    config, model = load_model(checkpoint_path, config)
+    model = set_precision(model, precision, config.device)
+    for lines in read_blocks(sys.stdin, lines_per_block):
+        sys.stdout.write(predict_lines(config, model, lines))
+    sys.stdout.flush()
+
 
 # modification of the wordpiece tokenizer to keep case information even if vocab is lower cased
 # forked from https://github.com/huggingface/transformers/blob/master/src/transformers/models/bert/tokenization_bert.py
@@ -557,11 +791,33 @@ def preprocess_text_old_fr(config):
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
-    def __init__(self, vocab, unk_token, max_input_chars_per_word=100, keep_case=True):
+    def __init__(self, vocab, unk_token, max_input_chars_per_word=100, keep_case=True, cache_size=2 ** 16):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
         self.keep_case = keep_case
+        self.cache_size = cache_size
+        self._build()
+
+    def _build(self):
+        # prefix tries over the vocabulary, one for word starts and one for ## continuations
+        self.trie = {}
+        self.continuation_trie = {}
+        for piece in self.vocab:
+            _trie_insert(self.trie, piece)
+            if piece.startswith('##'):
+                _trie_insert(self.continuation_trie, piece[2:])
+        # speech repeats the same words a lot, whole word results are cached
+        self.tokenize_word = functools.lru_cache(maxsize=self.cache_size)(self._tokenize_word)
+
+    def __getstate__(self):
+        # tokenizers end up pickled in checkpoint configs, the tries and cache are rebuilt on load
+        return {key: value for key, value in self.__dict__.items() if key not in ('trie', 'continuation_trie', 'tokenize_word')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache_size = state.get('cache_size', 2 ** 16)
+        self._build()
 
     def tokenize(self, text):
         """
@@ -577,96 +833,164 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in text.strip().split():
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
+            output_tokens.extend(self.tokenize_word(token))
+        return output_tokens
 
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    # optionaly lowercase substring before checking for inclusion in vocab
-                    if (self.keep_case and substr.lower() in self.vocab) or (substr in self.vocab):
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
+    def _tokenize_word(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+
+        lowered = token.lower()
+        if len(lowered) != len(token) or 'Σ' in token:
+            # lowercasing is not character by character (length changes, final sigma),
+            # substrings have to be lowercased one by one
+            return self._tokenize_word_by_substrings(token)
+
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            trie = self.trie if start == 0 else self.continuation_trie
+            # optionaly lowercase substring before checking for inclusion in vocab
+            end = _trie_longest_match(trie, token, start)
+            if self.keep_case:
+                end = max(end, _trie_longest_match(trie, lowered, start))
+            if end == start:
+                return (self.unk_token,)
+            sub_tokens.append(token[start:end] if start == 0 else "##" + token[start:end])
+            start = end
+        return tuple(sub_tokens)
+
+    def _tokenize_word_by_substrings(self, token):
+        chars = list(token)
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if (self.keep_case and substr.lower() in self.vocab) or (substr in self.vocab):
+                    cur_substr = substr
                     break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-            else:
-                output_tokens.extend(sub_tokens)
-        return output_tokens
+                end -= 1
+            if cur_substr is None:
+                return (self.unk_token,)
+            sub_tokens.append(cur_substr)
+            start = end
+        return tuple(sub_tokens)
+
+
+def _trie_insert(trie, piece):
+    node = trie
+    for char in piece:
+        node = node.setdefault(char, {})
+    node[None] = True
+
+
+def _trie_longest_match(trie, word, start):
+    """End of the longest vocabulary entry in word starting at start, or start if there is none."""
+    node = trie
+    end = start
+    for i in range(start, len(word)):
+        node = node.get(word[i])
+        if node is None:
+            break
+        if None in node:
+            end = i + 1
+    return end
 
 
 # modification of XLM bpe tokenizer for keeping case information when vocab is lowercase
 # forked from https://github.com/huggingface/transformers/blob/cd56f3fe7eae4a53a9880e3f5e8f91877a78271c/src/transformers/models/xlm/tokenization_xlm.py
 def bpe(self, token):
-    def to_lower(pair):
-      #print('  ',pair)
-      return (pair[0].lower(), pair[1].lower())
-
-    from transformers.models.xlm.tokenization_xlm import get_pairs
-
-    word = tuple(token[:-1]) + (token[-1] + "</w>",)
-    if token in self.cache:
-        return self.cache[token]
-    pairs = get_pairs(word)
+    cached = self.cache.lookup(token)
+    if cached is not None:
+        return cached
 
-    if not pairs:
+    word = list(token[:-1]) + [token[-1] + "</w>"]
+    if len(word) < 2:
         return token + "</w>"
 
-    while True:
-        bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(to_lower(pair), float("inf")))
-        #print(bigram)
-        if to_lower(bigram) not in self.bpe_ranks:
+    # symbols are lowercased once when created, not for every candidate pair of every merge
+    lowered = [symbol.lower() for symbol in word]
+    ranks = self.lower_bpe_ranks
+    while len(word) > 1:
+        # lowest ranked pair, leftmost on ties between case variants of the same merge
+        best = None
+        best_rank = None
+        for i in range(len(word) - 1):
+            rank = ranks.get(lowered[i], _no_ranks).get(lowered[i + 1])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best, best_rank = i, rank
+        if best is None:
             break
-        first, second = bigram
+        first, second = word[best], word[best + 1]
         new_word = []
+        new_lowered = []
         i = 0
         while i < len(word):
-            try:
-                j = word.index(first, i)
-            except ValueError:
-                new_word.extend(word[i:])
-                break
-            else:
-                new_word.extend(word[i:j])
-                i = j
-
             if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
                 new_word.append(first + second)
+                new_lowered.append(new_word[-1].lower())
                 i += 2
             else:
                 new_word.append(word[i])
+                new_lowered.append(lowered[i])
                 i += 1
-        new_word = tuple(new_word)
         word = new_word
-        if len(word) == 1:
-            break
-        else:
-            pairs = get_pairs(word)
+        lowered = new_lowered
     word = " ".join(word)
     if word == "\n  </w>":
         word = "\n</w>"
-    self.cache[token] = word
+    self.cache.store(token, word)
     return word
 
 
+_no_ranks = {}
+
+
+def lowercase_bpe_ranks(bpe_ranks):
+    """Index merge ranks as {first: {second: rank}}, to look up lowercased pairs without building tuples."""
+    ranks = {}
+    for (first, second), rank in bpe_ranks.items():
+        ranks.setdefault(first, {})[second] = rank
+    return ranks
+
+
+class LRUCache(collections.OrderedDict):
+    """Size-bounded mapping evicting the least recently used entries, with hit and miss counters."""
+
+    def __init__(self, maxsize=2 ** 16):
+        super().__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        try:
+            self.move_to_end(key)
+            value = self[key]
+        except KeyError:
+            # also covers entries evicted by another thread in the meantime
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        self[key] = value
+        while len(self) > self.maxsize:
+            try:
+                self.popitem(last=False)
+            except KeyError:
+                break
+
 
 def init(config):
     init_random(config.seed)
+    from transformers import AutoTokenizer, BertTokenizer
     
     if config.lang == 'fr':
         config.tokenizer = tokenizer = AutoTokenizer.from_pretrained(config.flavor, do_lower_case=False)
@@ -677,6 +1001,8 @@ def init(config):
         # monkey patch XLM tokenizer
         import types
         tokenizer.bpe = types.MethodType(bpe, tokenizer)
+        tokenizer.lower_bpe_ranks = lowercase_bpe_ranks(tokenizer.bpe_ranks)
+        tokenizer.cache = LRUCache()
     else:
         # warning: needs to be BertTokenizer for monkey patching to work
         config.tokenizer = tokenizer = BertTokenizer.from_pretrained(config.flavor, do_lower_case=False) 
@@ -703,26 +1029,89 @@ def init(config):
     config.device = torch.device(config.device if torch.cuda.is_available() else 'cpu')
     
 
+# training and preprocessing code lives in separate modules that are only imported when
+# used, its functions remain accessible as attributes of this module
+lazy_modules = {
+    'training': ['drop_at_boundaries', 'DropAtBoundariesCollate', 'compute_performance', 'prf', 'class_scores',
+        'distillation_loss', 'fit', 'load_array', 'WindowDataset', 'ShardedShuffleSampler', 'make_loader', 'train',
+        'layers_key', 'make_student', 'distill', 'run_eval', 'label_fscores', 'compare_precisions', 'serialized_size'],
+    'preprocessing': ['label_for_case', 'is_labeled_tsv', 'shard_offsets', 'read_shard', 'tensorize_shard', 'make_tensors',
+        'labeled_tokens', 'preprocess_lines', 'preprocess_text', 'preprocess_text_old_fr'],
+}
+lazy_attributes = {name: module for module, names in lazy_modules.items() for name in names}
+
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        return getattr(importlib.import_module(lazy_attributes[name]), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def import_time_report(*modules):
+    """Where the time to import modules goes, measured in a fresh interpreter with -X importtime.
+
+    Prints the total, the time spent in each top-level package (own time of all its modules)
+    and the slowest modules including what they import.
+    """
+    import subprocess
+    modules = modules or ('recasepunc',)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+            cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), len(name) - len(name.lstrip()), int(own), int(cumulative)))
+    top_level = min(depth for _, depth, _, _ in entries)
+    packages = collections.Counter()
+    for name, _, own, _ in entries:
+        packages[name.split('.')[0]] += own
+    print(json.dumps({
+        'modules': modules,
+        'total_seconds': sum(cumulative for _, depth, _, cumulative in entries if depth == top_level) / 1e6,
+        'packages': {package: own / 1e6 for package, own in packages.most_common(20)},
+        'slowest_modules': {name: cumulative / 1e6 for name, _, _, cumulative in sorted(entries, key=lambda entry: -entry[3])[:20]},
+    }, indent=2))
+
+
 def main(config, action, args):
+    if action == 'import-time':
+        # does not need a model or tokenizer
+        import_time_report(*args)
+        return
+
+    if config.threads > 0:
+        torch.set_num_threads(config.threads)
     init(config)
 
     if action == 'train':
-        train(config, *args)
+        __getattr__('train')(config, *args)
     elif action == 'eval':
-        run_eval(config, *args)
+        __getattr__('run_eval')(config, *args)
+    elif action == 'distill':
+        __getattr__('distill')(config, *args)
     elif action == 'predict': 
         generate_predictions(config, *args)
     elif action == 'tensorize':
-        make_tensors(config, *args)
+        __getattr__('make_tensors')(config, *args)
     elif action == 'preprocess':
-        preprocess_text(config, *args)
+        __getattr__('preprocess_text')(config, *args)
+    elif action == 'export':
+        export_model(config, *args)
+    elif action == 'compare-precision':
+        __getattr__('compare_precisions')(config, *args)
     else:
         print('invalid action "%s"' % action)
         sys.exit(1) 
 
 if __name__ == '__main__':
+    # training and preprocessing import this module by name, make them share the running one
+    sys.modules.setdefault('recasepunc', sys.modules[__name__])
+
     parser = argparse.ArgumentParser()
-    parser.add_argument("action", help="train|eval|predict|tensorize|preprocess", type=str)
+    parser.add_argument("action", help="train|eval|distill|predict|tensorize|preprocess|export|compare-precision|import-time", type=str)
     parser.add_argument("action_args", help="arguments for selected action", type=str, nargs='*')
     parser.add_argument("--seed", help="random seed", default=default_config.seed, type=int)
     parser.add_argument("--lang", help="language (fr, en, zh)", default=default_config.lang, type=str)
@@ -730,11 +1119,20 @@ if __name__ == '__main__':
     parser.add_argument("--max-length", help="maximum input length", default=default_config.max_length, type=int)
     parser.add_argument("--batch-size", help="size of batches", default=default_config.batch_size, type=int)
     parser.add_argument("--device", help="computation device (cuda, cpu)", default=default_config.device, type=str)
-    parser.add_argument("--debug", help="whether to output more debug info", default=default_config.debug, type=bool)
-    parser.add_argument("--updates", help="number of training updates to perform", default=default_config.updates, type=bool)
-    parser.add_argument("--period", help="validation period in updates", default=default_config.period, type=bool)
-    parser.add_argument("--lr", help="learning rate", default=default_config.lr, type=bool)
-    parser.add_argument("--dab-rate", help="drop at boundaries rate", default=default_config.dab_rate, type=bool)
+    parser.add_argument("--precision", help="inference precision (%s)" % ', '.join(precisions), default=default_config.precision, choices=precisions, type=str)
+    parser.add_argument("--workers", help="number of worker processes for predict, preprocess, tensorize and data loading", default=default_config.workers, type=int)
+    parser.add_argument("--threads", help="number of intra-op threads, 0 for the torch default", default=default_config.threads, type=int)
+    parser.add_argument("--debug", help="whether to output more debug info", default=default_config.debug, action='store_true')
+    parser.add_argument("--updates", help="number of training updates to perform", default=default_config.updates, type=int)
+    parser.add_argument("--period", help="validation period in updates", default=default_config.period, type=int)
+    parser.add_argument("--lr", help="learning rate", default=default_config.lr, type=float)
+    parser.add_argument("--accumulate", help="number of batches accumulated in each training update", default=default_config.accumulate, type=int)
+    parser.add_argument("--train-precision", help="training precision (fp32, bf16 autocast)", default=default_config.train_precision, choices=['fp32', 'bf16'], type=str)
+    parser.add_argument("--student-layers", help="number of encoder layers of the distilled student", default=default_config.student_layers, type=int)
+    parser.add_argument("--student-width", help="hidden size of the distilled student (bert-like flavors only), defaults to the teacher's", default=default_config.student_width, type=int)
+    parser.add_argument("--temperature", help="softmax temperature of distillation targets", default=default_config.temperature, type=float)
+    parser.add_argument("--distill-alpha", help="weight of the distillation loss against the label loss", default=default_config.distill_alpha, type=float)
+    parser.add_argument("--dab-rate", help="drop at boundaries rate", default=default_config.dab_rate, type=float)
     config = Config(**parser.parse_args().__dict__)
 
     main(config, config.action, config.action_args)
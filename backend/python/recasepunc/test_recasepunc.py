@@ -0,0 +1,122 @@
+"""Checks that models trained with the command line load from other scripts, and of the micro-batcher.
+
+    python3 -m unittest test_recasepunc
+
+Builds a tiny randomly initialized bert model so that it runs offline and in a few
+seconds, trains it for two updates with recasepunc.py and loads the checkpoint.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+fixture = os.path.join(here, 'vosk-adapted.txt')
+
+
+def make_tiny_flavor(directory):
+    from transformers import BertConfig, BertModel
+    with open(fixture) as fp:
+        words = sorted(set(fp.read().lower().split()))
+    letters = sorted(set(''.join(words)))
+    with open(os.path.join(directory, 'vocab.txt'), 'w') as fp:
+        fp.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + letters + ['##' + letter for letter in letters] + words) + '\n')
+    bert_config = BertConfig(vocab_size=5 + 2 * len(letters) + len(words), hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64)
+    BertModel(bert_config).save_pretrained(directory)
+
+
+def run(*args, cwd=here, path=here):
+    env = dict(os.environ, HF_HUB_OFFLINE='1', PYTHONPATH=path)
+    result = subprocess.run([sys.executable] + list(args), cwd=cwd, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError('%s failed:\n%s' % (' '.join(args), result.stderr))
+    return result.stdout
+
+
+class CommandLineCheckpointTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.flavor = os.path.join(cls.tmp.name, 'tiny')
+        os.mkdir(cls.flavor)
+        make_tiny_flavor(cls.flavor)
+        options = ['--flavor', cls.flavor, '--device', 'cpu', '--lang', 'en']
+        x, y = os.path.join(cls.tmp.name, 'x.npy'), os.path.join(cls.tmp.name, 'y.npy')
+        run('recasepunc.py', 'tensorize', fixture + '.punc', x, y, *options)
+        run('recasepunc.py', 'train', x, y, x, y, os.path.join(cls.tmp.name, 'model'),
+            '--updates', '2', '--period', '2', '--batch-size', '4', '--max-length', '64', *options)
+        cls.checkpoint = os.path.join(cls.tmp.name, 'model.2')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_checkpoint_pickles_main(self):
+        # the checkpoint holds the tokenizer, pickled from recasepunc.py running as __main__
+        with open(self.checkpoint, 'rb') as fp:
+            self.assertIn(b'__main__', fp.read())
+
+    def test_load_model(self):
+        # loads in a fresh process, where __main__ is not recasepunc
+        output = run('-c', 'import sys; from recasepunc import CasePuncPredictor; '
+                     'print(CasePuncPredictor(sys.argv[1], lang="en", device="cpu").punctuate("hello how are you"))',
+                     self.checkpoint)
+        self.assertEqual(''.join(c for c in output.lower() if c.isalpha()), 'hellohowareyou')
+
+    def test_example(self):
+        os.symlink(self.checkpoint, os.path.join(self.tmp.name, 'checkpoint'))
+        with open(os.path.join(self.tmp.name, 'input.txt'), 'w') as fp:
+            fp.write('hello how are you\n')
+        output = run(os.path.join(here, 'example.py'), 'input.txt', cwd=self.tmp.name)
+        self.assertTrue(output.strip())
+
+    def test_benchmark(self):
+        results = os.path.join(self.tmp.name, 'results.json')
+        run('benchmark.py', self.checkpoint, '--output', results, '--synthetic-words', '100', '--repeat', '1')
+        output = run('benchmark.py', self.checkpoint, '--baseline', results, '--synthetic-words', '100', '--repeat', '1')
+        self.assertEqual(json.loads(output)['deltas']['punc_fscore'], 0)
+
+    def test_vosk_backend_predictor(self):
+        # as loaded by app.py, which only has backend/python on its path
+        backend = os.path.dirname(here)
+        output = run('-c', 'import sys; from transcription import VoskBackend; '
+                     'predictor = VoskBackend._load_predictor(sys.argv[1], "en", "cpu", "fp32"); '
+                     'print(predictor.punctuate("hello how are you")); predictor.stop_batching()',
+                     self.checkpoint, cwd=backend, path=backend)
+        self.assertEqual(''.join(c for c in output.lower() if c.isalpha()), 'hellohowareyou')
+
+
+class MicroBatcherTest(unittest.TestCase):
+
+    class ZeroModel:
+        def __call__(self, x, attention_mask=None):
+            import torch
+            return torch.zeros(*x.shape, 5), torch.zeros(*x.shape, 4)
+
+    def test_close(self):
+        from recasepunc import MicroBatcher
+        batcher = MicroBatcher(self.ZeroModel(), 0, 'cpu')
+        self.assertEqual(len(batcher.run([[1, 2, 3]])), 1)
+        batcher.close()
+        batcher.close()
+        with self.assertRaises(RuntimeError):
+            batcher.submit([[1]])
+
+    def test_requests_queued_after_close_fail(self):
+        from concurrent.futures import Future
+        from recasepunc import MicroBatcher
+        batcher = MicroBatcher(self.ZeroModel(), 0, 'cpu')
+        # a request that got behind the sentinel
+        future = Future()
+        batcher.queue.put(None)
+        batcher.queue.put(([[1]], future))
+        batcher.thread.join()
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
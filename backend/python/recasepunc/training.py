@@ -0,0 +1,484 @@
+"""Training, distillation and evaluation of recasepunc models.
+
+Kept out of recasepunc.py so that inference does not import the optimizer, data loading
+and progress reporting code. The recasepunc command line imports it for train, eval,
+distill and compare-precision.
+"""
+import functools
+import io
+import json
+import time
+import regex as re
+from tqdm import tqdm
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import numpy as np
+from torch.utils.data import Dataset, DataLoader, Sampler
+
+from recasepunc import Config, Model, CasePuncPredictor, init, load_checkpoint, load_model, precisions, punctuation, case
+from preprocessing import labeled_tokens
+
+
+# randomly create sequences that align to punctuation boundaries
+def drop_at_boundaries(rate, x, y, cls_token_id, sep_token_id, pad_token_id):
+    """Crop a random subset of rows, in place, so that they start and end at sentence boundaries.
+
+    Each selected row keeps the text between its first sentence ending and a random later
+    one, wrapped in cls/sep and padded. All rows are processed at once with masked tensor
+    operations, random draws come from the torch generator so init_random makes it reproducible.
+    """
+    batch_size, length = x.shape
+    device = x.device
+    dropped = (torch.rand(batch_size) < rate).to(device)
+    draw = torch.rand(batch_size).to(device)
+
+    # select all indices that are sentence endings
+    boundaries = y[:, :, 0] > 1
+    num_boundaries = boundaries.sum(1)
+    rank = boundaries.cumsum(1) - 1
+    # keep from the first ending to the k-th one, with k drawn in [1, num_boundaries - 1]
+    k = 1 + (draw * (num_boundaries - 1).clamp(min=1)).long()
+    start = boundaries.int().argmax(1) + 1
+    end = (boundaries & (rank == k.unsqueeze(1))).int().argmax(1) + 1
+    span = end - start
+    selected = dropped & (num_boundaries >= 2) & (span + 2 <= length)
+    if not selected.any():
+        return
+
+    positions = torch.arange(length, device=device).unsqueeze(0)
+    source = (start.unsqueeze(1) + positions - 1).clamp(0, length - 1)
+    inside = (positions >= 1) & (positions <= span.unsqueeze(1))
+    cropped_x = torch.where(inside, x.gather(1, source),
+            torch.where(positions == span.unsqueeze(1) + 1, sep_token_id, pad_token_id).to(x.dtype))
+    cropped_x[:, 0] = cls_token_id
+    cropped_y = torch.where(inside.unsqueeze(2), y.gather(1, source.unsqueeze(2).expand(-1, -1, y.size(2))), 0)
+
+    rows = selected.unsqueeze(1)
+    x.copy_(torch.where(rows, cropped_x, x))
+    y.copy_(torch.where(rows.unsqueeze(2), cropped_y, y))
+
+
+class DropAtBoundariesCollate:
+    """DataLoader collate_fn that applies drop_at_boundaries to each batch.
+
+    Running the augmentation as part of batching lets DataLoader workers prepare it while
+    the model trains on the previous batch.
+    """
+
+    def __init__(self, rate, cls_token_id, sep_token_id, pad_token_id):
+        self.rate = rate
+        self.cls_token_id = cls_token_id
+        self.sep_token_id = sep_token_id
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, batch):
+        x, y = torch.utils.data.default_collate(batch)
+        drop_at_boundaries(self.rate, x, y, self.cls_token_id, self.sep_token_id, self.pad_token_id)
+        return x, y
+
+
+def compute_performance(config, model, loader):
+    """Loss, case and punctuation accuracy, punctuation F-scores and a per-class report.
+
+    Punctuation and case confusion matrices are accumulated on the device with a single
+    bincount per batch, padding excluded, and everything is derived from them at the end.
+    fscore[0] is the micro-average over punctuation marks (all labels but O).
+    """
+    device = config.device
+    criterion = nn.CrossEntropyLoss()
+    model.eval()
+    num_punc = len(punctuation)
+    num_case = len(case)
+    confusion = torch.zeros(num_punc * num_punc + num_case * num_case, dtype=torch.long, device=device)
+    total_loss = torch.zeros((), device=device)
+    num_loss = 0
+    for x, y in loader:
+        x = x.long().to(device)
+        y = y.long().to(device)
+        y1 = y[:,:,0]
+        y2 = y[:,:,1]
+        # padding, including that of windows cropped by drop_at_boundaries, is masked as in inference
+        tokens = x != config.pad_token_id
+        with torch.no_grad():
+            y_scores1, y_scores2 = model(x, tokens.long())
+            loss1 = criterion(y_scores1.view(y1.size(0) * y1.size(1), -1), y1.view(y1.size(0) * y1.size(1)))
+            loss2 = criterion(y_scores2.view(y2.size(0) * y2.size(1), -1), y2.view(y2.size(0) * y2.size(1)))
+            total_loss += loss1 + loss2
+            y_pred1 = torch.max(y_scores1, 2)[1]
+            y_pred2 = torch.max(y_scores2, 2)[1]
+            # cells of the punctuation matrix come first, then those of the case matrix
+            cells = torch.cat([(y1 * num_punc + y_pred1)[tokens], num_punc * num_punc + (y2 * num_case + y_pred2)[tokens]])
+            confusion += torch.bincount(cells, minlength=len(confusion))
+            num_loss += len(y)
+    confusion = confusion.cpu()
+    confusion_punc = confusion[:num_punc * num_punc].view(num_punc, num_punc)
+    confusion_case = confusion[num_punc * num_punc:].view(num_case, num_case)
+    num_tokens = max(confusion_punc.sum().item(), 1)
+
+    punc_scores = class_scores(confusion_punc, punctuation)
+    fscore = {label: punc_scores[name]['fscore'] for name, label in punctuation.items()}
+    fscore[0] = prf(confusion_punc[1:, 1:].diagonal().sum().item(), confusion_punc[1:].sum().item(), confusion_punc[:, 1:].sum().item())['fscore']
+    report = {
+        'punctuation': punc_scores,
+        'case': class_scores(confusion_case, case),
+        'punctuation_confusion': confusion_punc.tolist(),
+        'case_confusion': confusion_case.tolist(),
+    }
+    return total_loss.item() / num_loss, confusion_case.trace().item() / num_tokens, confusion_punc.trace().item() / num_tokens, fscore, report
+
+
+def prf(num_correct, num_ref, num_hyp):
+    recall = num_correct / num_ref if num_ref > 0 else 0
+    precision = num_correct / num_hyp if num_hyp > 0 else 0
+    fscore = 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0
+    return {'precision': precision, 'recall': recall, 'fscore': fscore, 'support': num_ref}
+
+
+def class_scores(confusion, labels):
+    """Precision, recall and F-score of each class of a confusion matrix (reference x hypothesis)."""
+    correct = confusion.diagonal().tolist()
+    num_ref = confusion.sum(1).tolist()
+    num_hyp = confusion.sum(0).tolist()
+    return {name: prf(correct[label], num_ref[label], num_hyp[label]) for name, label in labels.items()}
+
+
+def distillation_loss(scores, teacher_scores, temperature):
+    # KL divergence between temperature-softened distributions, per token, scaled so
+    # that gradients keep the same magnitude whatever the temperature
+    scores = scores.view(-1, scores.size(-1)) / temperature
+    teacher_scores = teacher_scores.view(-1, teacher_scores.size(-1)) / temperature
+    return F.kl_div(F.log_softmax(scores, -1), F.log_softmax(teacher_scores, -1), reduction='batchmean', log_target=True) * temperature ** 2
+
+
+def fit(config, model, checkpoint_path, train_loader, valid_loader, iterations, valid_period=200, lr=1e-5, teacher=None):
+    """Train the model, saving a checkpoint every valid_period updates.
+
+    Each update accumulates the gradients of config.accumulate batches, optionally under bf16
+    autocast (config.train_precision). Throughput and timings of each period are appended
+    to <checkpoint_path>.log.jsonl along with the validation scores.
+
+    When a teacher is given, the loss mixes the label cross-entropy with the divergence from
+    the teacher's punctuation and case scores, weighted by config.distill_alpha.
+    """
+    device = config.device
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(filter(lambda param: param.requires_grad, model.parameters()), lr=lr)
+    autocast = functools.partial(torch.autocast, torch.device(device).type, dtype=torch.bfloat16, enabled=config.train_precision == 'bf16')
+    iteration = 0
+    step = 0
+    # loss and token counts stay on the device until the end of a period to avoid syncs
+    total_loss = torch.zeros((), device=device)
+    num_tokens = torch.zeros((), dtype=torch.long, device=device)
+    num = 0
+    period_start = time.perf_counter()
+    while True:
+        model.train()
+        for x, y in tqdm(train_loader):
+            x = x.long().to(device)
+            y = y.long().to(device)
+            y1 = y[:,:,0]
+            y2 = y[:,:,1]
+            tokens = x != config.pad_token_id
+            with autocast():
+                y_scores1, y_scores2 = model(x, tokens.long())
+                loss1 = criterion(y_scores1.view(y1.size(0) * y1.size(1), -1), y1.view(y1.size(0) * y1.size(1)))
+                loss2 = criterion(y_scores2.view(y2.size(0) * y2.size(1), -1), y2.view(y2.size(0) * y2.size(1)))
+                loss = loss1 + loss2
+                if teacher is not None:
+                    with torch.inference_mode():
+                        teacher_scores1, teacher_scores2 = teacher(x, tokens.long())
+                    soft_loss = distillation_loss(y_scores1, teacher_scores1, config.temperature) + distillation_loss(y_scores2, teacher_scores2, config.temperature)
+                    loss = (1 - config.distill_alpha) * loss + config.distill_alpha * soft_loss
+            (loss / config.accumulate).backward()
+            total_loss += loss.detach()
+            num_tokens += tokens.sum()
+            num += len(y)
+            step += 1
+            if step < config.accumulate:
+                continue
+            step = 0
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+            if iteration % valid_period == valid_period - 1:
+                train_loss = total_loss.item() / num
+                train_time = time.perf_counter() - period_start
+                valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore, valid_report = compute_performance(config, model, valid_loader)
+                checkpoint_fn = '%s.%d' % (checkpoint_path, iteration + 1)
+                torch.save({
+                    'iteration': iteration + 1,
+                    'model_state_dict': model.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'train_loss': train_loss,
+                    'valid_loss': valid_loss,
+                    'valid_accuracy_case': valid_accuracy_case,
+                    'valid_accuracy_punc': valid_accuracy_punc,
+                    'valid_fscore': valid_fscore,
+                    'valid_report': valid_report,
+                    'config': config.__dict__,
+                }, checkpoint_fn)
+                with open(checkpoint_path + '.log.jsonl', 'a') as fp:
+                    print(json.dumps({
+                        'iteration': iteration + 1,
+                        'checkpoint': checkpoint_fn,
+                        'train_loss': train_loss,
+                        'valid_loss': valid_loss,
+                        'valid_accuracy_case': valid_accuracy_case,
+                        'valid_accuracy_punc': valid_accuracy_punc,
+                        'valid_fscore': valid_fscore[0],
+                        'tokens_per_second': num_tokens.item() / train_time,
+                        'samples_per_second': num / train_time,
+                        'step_time': train_time / valid_period,
+                        'valid_time': time.perf_counter() - period_start - train_time,
+                        'effective_batch_size': config.batch_size * config.accumulate,
+                        'train_precision': config.train_precision,
+                        'threads': torch.get_num_threads(),
+                    }), file=fp)
+                print(iteration + 1, train_loss, valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore, flush=True)
+                model.train()
+                total_loss.zero_()
+                num_tokens.zero_()
+                num = 0
+                period_start = time.perf_counter()
+
+            iteration += 1
+            if iteration > iterations:
+                return
+
+
+def load_array(fn):
+    """Memory-map tensorized data written by tensorize, older torch.save outputs are loaded in memory."""
+    with open(fn, 'rb') as fp:
+        is_numpy = fp.read(6) == b'\x93NUMPY'
+    if is_numpy:
+        return np.load(fn, mmap_mode='r')
+    return torch.load(fn).numpy()
+
+
+class WindowDataset(Dataset):
+    """max_length windows of tensorized ids and labels, read lazily from memory-mapped files.
+
+    Only the windows being batched are paged in, so the corpus does not need to fit in
+    memory. The files are opened again in each DataLoader worker rather than pickled.
+    """
+
+    def __init__(self, x_fn, y_fn, max_length):
+        self.x_fn = x_fn
+        self.y_fn = y_fn
+        self.max_length = max_length
+        self.x = self.y = None
+        self._open()
+        assert len(self.x) == len(self.y)
+        self.num_windows = len(self.x) // max_length
+
+    def _open(self):
+        self.x = load_array(self.x_fn)
+        self.y = load_array(self.y_fn)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['x'] = state['y'] = None
+        return state
+
+    def __len__(self):
+        return self.num_windows
+
+    def __getitem__(self, index):
+        if self.x is None:
+            self._open()
+        start = index * self.max_length
+        x = torch.from_numpy(np.array(self.x[start: start + self.max_length]))
+        y = torch.from_numpy(np.array(self.y[start: start + self.max_length]))
+        return x, y
+
+
+class ShardedShuffleSampler(Sampler):
+    """Shuffles windows so that reads stay local in the memory-mapped files.
+
+    Windows are grouped in shards of consecutive windows. Shards are visited in random
+    order, mix_shards at a time, and the windows of the shards being visited are shuffled
+    together. Randomness comes from the torch generator, so init_random makes it reproducible.
+    """
+
+    def __init__(self, num_windows, shard_size=1024, mix_shards=8):
+        self.num_windows = num_windows
+        self.shard_size = shard_size
+        self.mix_shards = mix_shards
+
+    def __len__(self):
+        return self.num_windows
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        num_shards = (self.num_windows + self.shard_size - 1) // self.shard_size
+        shards = torch.randperm(num_shards, generator=generator).tolist()
+        for group in range(0, num_shards, self.mix_shards):
+            indices = torch.cat([torch.arange(shard * self.shard_size, min((shard + 1) * self.shard_size, self.num_windows)) for shard in shards[group: group + self.mix_shards]])
+            yield from indices[torch.randperm(len(indices), generator=generator)].tolist()
+
+
+def make_loader(config, dataset, shuffle=False, augment=False):
+    workers = config.workers
+    collate_fn = None
+    if augment and config.dab_rate > 0:
+        collate_fn = DropAtBoundariesCollate(config.dab_rate, config.cls_token_id, config.sep_token_id, config.pad_token_id)
+    return DataLoader(dataset, batch_size=config.batch_size,
+            sampler=ShardedShuffleSampler(len(dataset)) if shuffle else None, collate_fn=collate_fn,
+            num_workers=workers, persistent_workers=workers > 0, prefetch_factor=4 if workers > 0 else None,
+            pin_memory=torch.device(config.device).type == 'cuda')
+
+
+def train(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path):
+    train_set = WindowDataset(train_x_fn, train_y_fn, config.max_length)
+    valid_set = WindowDataset(valid_x_fn, valid_y_fn, config.max_length)
+
+    train_loader = make_loader(config, train_set, shuffle=True, augment=True)
+    valid_loader = make_loader(config, valid_set)
+
+    model = Model(config.flavor, config.device)
+
+    fit(config, model, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr)
+
+
+def layers_key(bert_config):
+    # name of the encoder depth setting, which differs between model types
+    return next(key for key in ['num_hidden_layers', 'n_layers', 'num_layers'] if key in bert_config)
+
+
+def make_student(config, teacher, num_layers=None, width=None):
+    """A smaller copy of the teacher's architecture, initialized from the teacher where possible.
+
+    num_layers keeps that many encoder layers, evenly spaced in the teacher and ending with its
+    last one. width narrows BERT-like encoders, in which case only the weights whose shape
+    still matches are copied and the rest is trained from scratch.
+    """
+    bert_config = teacher.bert.config.to_dict()
+    key = layers_key(bert_config)
+    teacher_layers = bert_config[key]
+    if num_layers is not None:
+        if not 0 < num_layers <= teacher_layers:
+            raise ValueError('student must have between 1 and %d layers' % teacher_layers)
+        bert_config[key] = num_layers
+    if width is not None:
+        if 'hidden_size' not in bert_config:
+            raise ValueError('cannot change the width of %s models' % bert_config.get('model_type'))
+        bert_config['hidden_size'] = width
+        bert_config['intermediate_size'] = 4 * width
+        bert_config['num_attention_heads'] = max(1, width // 64)
+    student = Model(config.flavor, config.device, bert_config)
+
+    student_layers = bert_config[key]
+    layer_map = {str(i): str((i + 1) * teacher_layers // student_layers - 1) for i in range(student_layers)}
+    teacher_state = teacher.state_dict()
+    state = student.state_dict()
+    for name, tensor in state.items():
+        # layer weights are indexed by the first number in their name
+        teacher_name = re.sub(r'\.(\d+)\.', lambda match: '.%s.' % layer_map.get(match.group(1), match.group(1)), name, count=1)
+        if teacher_name in teacher_state and teacher_state[teacher_name].shape == tensor.shape:
+            state[name] = teacher_state[teacher_name]
+    student.load_state_dict(state)
+    return student
+
+
+def distill(config, teacher_checkpoint_path, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path):
+    """Train a smaller student on the scores of a trained model, then compare them on the validation set."""
+    # the student must tokenize like the teacher, training parameters come from the command line
+    teacher_config, teacher = load_model(teacher_checkpoint_path, config)
+    if isinstance(teacher, torch.jit.ScriptModule):
+        raise ValueError('cannot distill from a torchscript export, use a checkpoint or safetensors export')
+    for key in ['lang', 'flavor', 'max_length']:
+        setattr(config, key, getattr(teacher_config, key))
+    init(config)
+    teacher.to(config.device)
+
+    student = make_student(config, teacher, config.student_layers, config.student_width)
+    config.bert_config = student.bert.config.to_dict()
+
+    train_set = WindowDataset(train_x_fn, train_y_fn, config.max_length)
+    valid_set = WindowDataset(valid_x_fn, valid_y_fn, config.max_length)
+    train_loader = make_loader(config, train_set, shuffle=True, augment=True)
+    valid_loader = make_loader(config, valid_set)
+
+    fit(config, student, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr, teacher=teacher)
+
+    results = {}
+    for name, model in [('teacher', teacher), ('student', student)]:
+        bert_config = model.bert.config.to_dict()
+        start = time.perf_counter()
+        loss, accuracy_case, accuracy_punc, fscore, report = compute_performance(config, model, valid_loader)
+        elapsed = time.perf_counter() - start
+        results[name] = {
+            'layers': bert_config[layers_key(bert_config)],
+            'punc_fscore': fscore[0],
+            'case_accuracy': accuracy_case,
+            'punc_accuracy': accuracy_punc,
+            'tokens_per_second': len(valid_set) * config.max_length / elapsed,
+            'model_mb': serialized_size(model) / 2 ** 20,
+        }
+    results['speedup'] = results['student']['tokens_per_second'] / results['teacher']['tokens_per_second']
+    results['punc_fscore_delta'] = results['student']['punc_fscore'] - results['teacher']['punc_fscore']
+    print(json.dumps(results, indent=2))
+
+
+def run_eval(config, test_x_fn, test_y_fn, checkpoint_path):
+    test_set = WindowDataset(test_x_fn, test_y_fn, config.max_length)
+    test_loader = make_loader(config, test_set)
+
+    loaded = load_checkpoint(checkpoint_path, config.device)
+    if 'config' in loaded:
+        config = Config(**loaded['config'])
+        init(config)
+
+    model = Model(config.flavor, config.device, config.bert_config)
+    model.load_state_dict(loaded['model_state_dict'])
+
+    loss, accuracy_case, accuracy_punc, fscore, report = compute_performance(config, model, test_loader)
+    print(loss, accuracy_case, accuracy_punc, fscore)
+    print(json.dumps(report, indent=2))
+
+
+def label_fscores(ref, hyp, ignored):
+    """Micro-averaged F-score over all labels except the ignored (default) one."""
+    num_ref = sum(1 for label in ref if label != ignored)
+    num_hyp = sum(1 for label in hyp if label != ignored)
+    num_correct = sum(1 for r, h in zip(ref, hyp) if r == h and r != ignored)
+    recall = num_correct / num_ref if num_ref > 0 else 0
+    precision = num_correct / num_hyp if num_hyp > 0 else 0
+    return 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0
+
+
+def compare_precisions(config, checkpoint_path, heldout_fn, *modes):
+    """Score each precision mode against the punctuated held-out file, relative to fp32."""
+    modes = list(modes) or precisions
+    if 'fp32' not in modes:
+        modes.insert(0, 'fp32')
+    with open(heldout_fn) as fp:
+        reference = [token for line in fp if line.strip() != '' for token in labeled_tokens(config, line)]
+    tokens = [config.cls_token] + [token for token, _, _ in reference] + [config.sep_token]
+
+    results = {}
+    for mode in modes:
+        predictor = CasePuncPredictor(checkpoint_path, lang=config.lang, flavor=config.flavor, device=config.device, precision=mode)
+        start = time.perf_counter()
+        hypothesis = list(predictor.predict(tokens))
+        elapsed = time.perf_counter() - start
+        results[mode] = {
+            'punc_fscore': label_fscores([punc for _, _, punc in reference], [punc for _, _, punc in hypothesis], 'O'),
+            'case_fscore': label_fscores([case for _, case, _ in reference], [case for _, case, _ in hypothesis], 'LOWER'),
+            'tokens_per_second': len(tokens) / elapsed,
+            'model_mb': serialized_size(predictor.model) / 2 ** 20,
+        }
+    for mode in modes:
+        for metric in ['punc_fscore', 'case_fscore']:
+            results[mode][metric + '_delta'] = results[mode][metric] - results['fp32'][metric]
+    print(json.dumps(results, indent=2))
+
+
+def serialized_size(model):
+    # also accounts for the packed weights of quantized layers, which are not parameters
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
@@ -0,0 +1,186 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from pcm_spool import SAMPLE_WIDTH, wav_bytes
+
+RECASEPUNC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recasepunc')
+
+
+class TranscriptionError(Exception):
+    """Raised by a backend that could not transcribe a chunk."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class TranscriptionBackend:
+    """Turns a block of 16-bit PCM samples into text.
+
+    Backends are created once per process and shared by request threads, so
+    transcribe() must be safe to call concurrently.
+    """
+    name = None
+
+    def transcribe(self, samples, frame_rate, channels=1):
+        raise NotImplementedError
+
+
+class WhisperApiBackend(TranscriptionBackend):
+    """Remote Whisper model served by the Hugging Face inference API."""
+    name = 'whisper-api'
+    API_URL = "https://api-inference.huggingface.co/models/openai/whisper-large-v3"
+
+    def __init__(self, token=None, retries=3, backoff_factor=2, timeout=30):
+        self.token = token if token is not None else os.getenv('HUGGING_TOKEN')
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+
+    def transcribe(self, samples, frame_rate, channels=1):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        data = wav_bytes(samples, frame_rate, channels)
+        error = None
+        for attempt in range(self.retries):
+            try:
+                response = requests.post(self.API_URL, headers=headers, data=data, timeout=self.timeout)
+                if response.status_code == 200:
+                    result = response.json()
+                    if isinstance(result, dict) and "text" in result:
+                        return result["text"].strip()
+                    error = f"unexpected response: {result}"
+                else:
+                    error = f"API returned status {response.status_code}"
+                print(f"{error}. Retrying...", file=sys.stderr)
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+                print(f"Request failed: {e}. Retrying...", file=sys.stderr)
+            time.sleep(self.backoff_factor ** attempt)
+        raise TranscriptionError("TIMEOUT", f"The transcription service timed out or encountered an error: {error}")
+
+
+class VoskBackend(TranscriptionBackend):
+    """On-box transcription with Vosk, punctuated and recased by recasepunc.
+
+    The Vosk model and the recasepunc predictor are loaded once per process and
+    shared by all instances with the same paths. Each chunk gets its own
+    recognizer, which is cheap, and samples are streamed to it in blocks.
+    Concurrent predictor calls share forward passes through its micro-batcher.
+    Without a recasepunc checkpoint the raw lowercase Vosk text is returned.
+    """
+    name = 'vosk'
+    BLOCK_FRAMES = 8000  # samples handed to the recognizer at a time
+
+    _lock = threading.Lock()
+    _models = {}
+    _predictors = {}
+
+    def __init__(self, model_path=None, checkpoint_path=None, lang=None, device=None, precision=None):
+        model_path = model_path or os.getenv('VOSK_MODEL_PATH')
+        if not model_path:
+            raise ValueError("VOSK_MODEL_PATH must point to an unpacked Vosk model")
+        checkpoint_path = checkpoint_path or os.getenv('RECASEPUNC_CHECKPOINT')
+        self.model = self._load_model(model_path)
+        self.predictor = None
+        if checkpoint_path:
+            self.predictor = self._load_predictor(
+                checkpoint_path,
+                lang or os.getenv('RECASEPUNC_LANG', 'en'),
+                device or os.getenv('RECASEPUNC_DEVICE', 'cpu'),
+                precision or os.getenv('RECASEPUNC_PRECISION', 'fp32'))
+
+    @classmethod
+    def _load_model(cls, model_path):
+        with cls._lock:
+            if model_path not in cls._models:
+                from vosk import Model, SetLogLevel
+                SetLogLevel(-1)
+                print(f"Loading Vosk model from {model_path}", file=sys.stderr)
+                cls._models[model_path] = Model(model_path)
+            return cls._models[model_path]
+
+    @classmethod
+    def _load_predictor(cls, checkpoint_path, lang, device, precision):
+        key = (checkpoint_path, lang, device, precision)
+        with cls._lock:
+            if key not in cls._predictors:
+                # recasepunc is bundled as a directory of scripts rather than a package
+                if RECASEPUNC_DIR not in sys.path:
+                    sys.path.insert(0, RECASEPUNC_DIR)
+                from recasepunc import CasePuncPredictor
+                print(f"Loading recasepunc checkpoint from {checkpoint_path}", file=sys.stderr)
+                predictor = CasePuncPredictor(checkpoint_path, lang=lang, device=device, precision=precision)
+                predictor.start_batching()
+                cls._predictors[key] = predictor
+            return cls._predictors[key]
+
+    def recognize(self, samples, frame_rate, channels=1):
+        """Raw Vosk transcript of a block of mono samples."""
+        from vosk import KaldiRecognizer
+        if channels != 1:
+            raise TranscriptionError("UNSUPPORTED_AUDIO", "Vosk expects mono audio")
+        recognizer = KaldiRecognizer(self.model, frame_rate)
+        pcm = memoryview(np.ascontiguousarray(samples)).cast('B')
+        block_size = self.BLOCK_FRAMES * SAMPLE_WIDTH
+        texts = []
+        for start in range(0, len(pcm), block_size):
+            if recognizer.AcceptWaveform(bytes(pcm[start: start + block_size])):
+                texts.append(json.loads(recognizer.Result()).get("text", ""))
+        texts.append(json.loads(recognizer.FinalResult()).get("text", ""))
+        return " ".join(text for text in texts if text)
+
+    def transcribe(self, samples, frame_rate, channels=1):
+        try:
+            text = self.recognize(samples, frame_rate, channels)
+            if text and self.predictor is not None:
+                text = self.predictor.punctuate(text)
+        except TranscriptionError:
+            raise
+        except Exception as e:
+            raise TranscriptionError("LOCAL_ERROR", f"Local transcription failed: {e}")
+        return text
+
+
+class FallbackBackend(TranscriptionBackend):
+    """Uses the primary backend, and the fallback for chunks the primary failed on."""
+
+    def __init__(self, primary, fallback):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    def transcribe(self, samples, frame_rate, channels=1):
+        try:
+            return self.primary.transcribe(samples, frame_rate, channels)
+        except TranscriptionError as e:
+            print(f"{self.primary.name} failed ({e}), falling back to {self.fallback.name}", file=sys.stderr)
+            return self.fallback.transcribe(samples, frame_rate, channels)
+
+
+BACKENDS = {
+    WhisperApiBackend.name: WhisperApiBackend,
+    VoskBackend.name: VoskBackend,
+}
+
+
+def create_backend(name=None, fallback=None):
+    """Backend selected by name or the TRANSCRIPTION_BACKEND environment variable.
+
+    TRANSCRIPTION_FALLBACK optionally names a second backend used when the first
+    fails on a chunk, e.g. vosk when the remote API is rate limited.
+    """
+    name = name or os.getenv('TRANSCRIPTION_BACKEND', WhisperApiBackend.name)
+    fallback = fallback if fallback is not None else os.getenv('TRANSCRIPTION_FALLBACK')
+    for backend_name in filter(None, [name, fallback]):
+        if backend_name not in BACKENDS:
+            raise ValueError(f"Unknown transcription backend {backend_name}, expected one of {', '.join(BACKENDS)}")
+    backend = BACKENDS[name]()
+    if fallback and fallback != name:
+        backend = FallbackBackend(backend, BACKENDS[fallback]())
+    return backend